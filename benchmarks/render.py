@@ -0,0 +1,127 @@
+# Бенчмарк рендеринга ленты: старая сборка f-строками против скомпилированных шаблонов
+# Обе стороны оборачивают ленту одной и той же страницей render_page, сравнивается только лента
+#
+#   python benchmarks/render.py --sizes 10 100 1000 5000 --repeat 5
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import entard  # noqa: E402
+
+
+def fake_rows(count):
+    author = SimpleNamespace(username='benchmark')
+    language_stats = [
+        SimpleNamespace(name=name, percent=perc, color=entard.language_color(name))
+        for name, perc in entard.parse_languages('Python:60, JavaScript:30, HTML:10')
+    ]
+    rows = []
+    for i in range(count):
+        project = SimpleNamespace(
+            id=i + 1,
+            title=f'Проект {i}',
+            description='Описание проекта ' * 10,
+            languages='Python:60, JavaScript:30, HTML:10',
+            language_stats=language_stats,
+            stars=i % 50,
+            created_at=datetime.utcnow(),
+            author=author,
+        )
+        rows.append((project, i % 20))
+    return rows
+
+
+# Прежняя реализация index(): карточки дописываются к строке в цикле
+def legacy_render(rows):
+    projects_html = ""
+    for project, files_count in rows:
+        langs_html = ""
+        if project.languages:
+            langs_html = '<div class="language-bar">'
+            for lang in project.languages.split(','):
+                if ':' in lang:
+                    name, perc = lang.split(':')
+                    color = f"hsl({hash(name) % 360}, 70%, 50%)"
+                    langs_html += f'<div class="language-fill" style="width: {perc}%; background-color: {color};" title="{name}: {perc}%"></div>'
+            langs_html += '</div>'
+        projects_html += f'''
+        <div class="col-md-4 mb-4">
+            <div class="card h-100">
+                <div class="card-body">
+                    <h5 class="card-title">{project.title}</h5>
+                    <p class="card-text text-muted">
+                        {project.description[:100]}{"..." if len(project.description) > 100 else ""}
+                    </p>
+                    {langs_html}
+                    <div class="d-flex justify-content-between align-items-center mt-3">
+                        <small class="text-muted">
+                            <i class="bi bi-person"></i> {project.author.username}
+                        </small>
+                        <small class="text-muted">
+                            <i class="bi bi-star"></i> {project.stars}
+                            <i class="bi bi-folder me-2 ms-2"></i> {files_count}
+                        </small>
+                    </div>
+                    <a href="/project/{project.id}" class="btn btn-sm btn-primary mt-2 w-100">Подробнее</a>
+                </div>
+            </div>
+        </div>
+        '''
+    content = f'''
+    <h1><i class="bi bi-code-slash"></i> Entard</h1>
+    <div class="row mt-4">
+        {projects_html}
+    </div>
+    '''
+    return entard.render_page("Главная", content)
+
+
+def template_render(rows):
+    content = entard.FEED_TEMPLATE.render(rows=rows, cursor=None, next_cursor=None)
+    return entard.render_page("Главная", content)
+
+
+def measure(func, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(rows)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    args = parser.parse_args()
+
+    results = []
+    with entard.app.test_request_context('/'):
+        for size in args.sizes:
+            rows = fake_rows(size)
+            before = measure(legacy_render, rows, args.repeat)
+            after = measure(template_render, rows, args.repeat)
+            results.append({
+                'cards': size,
+                'legacy_ms': round(before * 1000, 3),
+                'template_ms': round(after * 1000, 3),
+            })
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(f"{'карточек':>10} {'f-строки, мс':>14} {'шаблоны, мс':>14}")
+    for row in results:
+        print(f"{row['cards']:>10} {row['legacy_ms']:>14.3f} {row['template_ms']:>14.3f}")
+
+
+if __name__ == '__main__':
+    main()
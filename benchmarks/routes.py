@@ -0,0 +1,376 @@
+# Нагрузочный бенчмарк маршрутов Entard
+#
+# Создаёт отдельную базу SQLite и папку загрузок, заполняет их пользователями, проектами
+# и файлами, затем гоняет маршруты через тестовый клиент Flask или настоящий WSGI-сервер
+# и печатает p50/p99, пропускную способность, число SQL-запросов на запрос и прирост RSS
+# за время замера маршрута.
+# Результат - JSON, который удобно сравнивать между коммитами:
+#
+#   python benchmarks/routes.py --projects 20000 --requests 300 --output before.json
+#   python benchmarks/routes.py --server --concurrency 16 --output after.json
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ROUTES = ['feed', 'feed_page2', 'trending', 'api_list', 'api_bulk', 'project', 'profile', 'download', 'upload', 'star']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Бенчмарк маршрутов Entard')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--projects', type=int, default=2000)
+    parser.add_argument('--files-per-project', type=int, default=5)
+    parser.add_argument('--file-size', type=int, default=16 * 1024, help='размер файла в байтах')
+    parser.add_argument('--requests', type=int, default=200, help='запросов на маршрут')
+    parser.add_argument('--warmup', type=int, default=10, help='прогревочных запросов на маршрут')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('--server', action='store_true', help='настоящий WSGI-сервер вместо тестового клиента')
+    parser.add_argument('--concurrency', type=int, default=8, help='параллельных клиентов в режиме --server')
+    parser.add_argument('--page-cache', action='store_true', help='включить кэш страниц')
+    parser.add_argument('--workdir', help='каталог для базы и файлов (по умолчанию временный)')
+    parser.add_argument('--keep', action='store_true', help='не удалять рабочий каталог')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='файл для JSON (по умолчанию stdout)')
+    return parser.parse_args()
+
+
+def configure_environment(args, workdir):
+    # Приложение читает настройки из окружения при импорте, поэтому задаём их до import entard
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads')
+    os.environ['PAGE_CACHE_ENABLED'] = '1' if args.page_cache else '0'
+    os.environ['JOB_INLINE_WORKERS'] = '0'
+    os.environ.setdefault('STAR_FLUSH_INTERVAL', '0')
+    sys.path.insert(0, ROOT)
+
+
+def seed(entard, args, rng):
+    db = entard.db
+    password_hash = entard.generate_password_hash('benchmark')
+    now = datetime.utcnow()
+    with entard.app.app_context():
+        db.session.execute(db.insert(entard.User), [
+            {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com',
+             'password_hash': password_hash, 'created_at': now}
+            for i in range(1, args.users + 1)
+        ])
+        # Несколько разных содержимых на весь набор, как в жизни: одни и те же файлы грузят снова
+        blobs = []
+        for i in range(max(1, args.files_per_project)):
+            data = (f'# file {i}\n'.encode() + os.urandom(args.file_size // 2).hex().encode())[:args.file_size]
+            tmp = os.path.join(entard.upload_tmp_dir(), f'seed-{i}')
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            sha256, size = entard.hash_file(tmp)
+            blobs.append((sha256, size, entard.store_blob(tmp, sha256)))
+        db.session.execute(db.insert(entard.Blob), [
+            {'sha256': sha256, 'size': size, 'refcount': 0, 'created_at': now} for sha256, size, _ in blobs
+        ])
+        languages = ['Python:60, JavaScript:30, HTML:10', 'Rust:80, Shell:20', 'Go:100', 'TypeScript:70, CSS:30']
+        extensions = ['.py', '.js', '.rs', '.go', '.txt']
+        batch = 1000
+        for start in range(1, args.projects + 1, batch):
+            ids = range(start, min(start + batch, args.projects + 1))
+            projects, langs, files = [], [], []
+            for project_id in ids:
+                text = rng.choice(languages)
+                projects.append({
+                    'id': project_id, 'title': f'Проект {project_id}', 'description': 'Описание проекта ' * 8,
+                    'languages': text, 'languages_auto': False, 'stars': rng.randint(0, 100), 'trending_score': rng.random() * 10,
+                    'user_id': rng.randint(1, args.users), 'files_folder': f'p{project_id}',
+                    'created_at': now - timedelta(minutes=args.projects - project_id),
+                })
+                for position, (name, perc) in enumerate(entard.parse_languages(text)):
+                    langs.append({'project_id': project_id, 'name': name, 'percent': perc, 'position': position})
+                for i in range(args.files_per_project):
+                    sha256, size, relpath = blobs[i % len(blobs)]
+                    files.append({
+                        'project_id': project_id, 'filename': f'file{i}{extensions[i % len(extensions)]}',
+                        'filepath': relpath, 'size': size, 'sha256': sha256, 'blob_sha256': sha256,
+                        'language': '', 'upload_date': now,
+                    })
+            db.session.execute(db.insert(entard.Project), projects)
+            db.session.execute(db.insert(entard.ProjectLanguage), langs)
+            if files:
+                db.session.execute(db.insert(entard.ProjectFile), files)
+            db.session.commit()
+        db.session.execute(db.text(
+            'UPDATE blob SET refcount = (SELECT COUNT(*) FROM project_file WHERE blob_sha256 = blob.sha256)'))
+        entard.recount_user_stats(db.session)
+        db.session.commit()
+        file_count = db.session.execute(db.select(db.func.max(entard.ProjectFile.id))).scalar() or 0
+        owned = dict(db.session.execute(
+            db.select(entard.Project.user_id, db.func.min(entard.Project.id)).group_by(entard.Project.user_id)
+        ).all())
+    return file_count, owned
+
+
+class QueryCounter:
+    # Считает SQL-запросы, выполненные за время замера
+    def __init__(self, engine, event):
+        self.lock = threading.Lock()
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        with self.lock:
+            self.count += 1
+
+    def take(self):
+        with self.lock:
+            count, self.count = self.count, 0
+        return count
+
+
+class RssSampler:
+    # Текущий RSS процесса (не пик с начала запуска) опрашивается в фоне во время замера
+    # одного маршрута; отчёт - насколько RSS вырос относительно начала замера. Нужен /proc
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+
+    def current_kb(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self.page_kb
+        except OSError:
+            return None
+
+    def __enter__(self):
+        self.start = self.peak = self.end = self.current_kb()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            rss = self.current_kb()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.end = self.current_kb()
+        if self.end is not None:
+            self.peak = max(self.peak, self.end)
+
+    def growth(self):
+        if self.start is None:
+            return None, None
+        return self.peak - self.start, self.end - self.start
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def session_cookie(entard, user_id):
+    serializer = entard.app.session_interface.get_signing_serializer(entard.app)
+    return serializer.dumps({'user_id': user_id, 'username': f'user{user_id}'})
+
+
+def build_requests(route, args, rng, ctx):
+    # Возвращает список (метод, путь, пользователь, тело multipart или None)
+    requests = []
+    for _ in range(args.warmup + args.requests):
+        if route == 'feed':
+            requests.append(('GET', '/', None, None))
+        elif route == 'feed_page2':
+            requests.append(('GET', '/?before=' + ctx['cursor'], None, None))
+        elif route == 'trending':
+            requests.append(('GET', '/trending', None, None))
+        elif route == 'api_list':
+            requests.append(('GET', '/api/v1/projects', None, None))
+        elif route == 'api_bulk':
+            ids = ','.join(str(rng.randint(1, args.projects)) for _ in range(50))
+            requests.append(('GET', f'/api/v1/projects?ids={ids}&fields=id,title,stars', None, None))
+        elif route == 'project':
+            requests.append(('GET', f"/project/{rng.randint(1, args.projects)}", None, None))
+        elif route == 'profile':
+            requests.append(('GET', '/profile', rng.choice(list(ctx['owned'])), None))
+        elif route == 'download':
+            requests.append(('GET', f"/download/{rng.randint(1, max(ctx['files'], 1))}", None, None))
+        elif route == 'upload':
+            user_id, project_id = rng.choice(list(ctx['owned'].items()))
+            payload = os.urandom(args.file_size)
+            requests.append(('POST', f'/project/{project_id}/upload', user_id, payload))
+        elif route == 'star':
+            requests.append(('POST', f"/project/{rng.randint(1, args.projects)}/star", rng.randint(1, args.users), None))
+    return requests
+
+
+def run_test_client(entard, requests):
+    client = entard.app.test_client()
+    results = []
+    for method, path, user_id, payload in requests:
+        with client.session_transaction() as sess:
+            sess.clear()
+            if user_id:
+                sess['user_id'] = user_id
+                sess['username'] = f'user{user_id}'
+        kwargs = {}
+        if payload is not None:
+            kwargs = {'data': {'files': [(io.BytesIO(payload), 'bench.bin')]}, 'content_type': 'multipart/form-data'}
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        response.get_data()
+        results.append((time.perf_counter() - start, response.status_code))
+    return results
+
+
+def run_server(entard, requests, port, concurrency):
+    boundary = 'entardbenchmarkboundary'
+
+    def one(request):
+        method, path, user_id, payload = request
+        headers = {}
+        body = None
+        if user_id:
+            headers['Cookie'] = f"{entard.app.config['SESSION_COOKIE_NAME']}={session_cookie(entard, user_id)}"
+        if payload is not None:
+            body = (f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="bench.bin"\r\n'
+                    f'Content-Type: application/octet-stream\r\n\r\n').encode() + payload + f'\r\n--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        start = time.perf_counter()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        elapsed = time.perf_counter() - start
+        conn.close()
+        return elapsed, response.status
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(one, requests))
+
+
+def summarize(route, results, wall, queries, rss, args):
+    timings = [elapsed for elapsed, _ in results]
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ms = lambda value: round(value * 1000, 3) if value is not None else None  # noqa: E731
+    return {
+        'route': route,
+        'requests': len(results),
+        'p50_ms': ms(percentile(timings, 50)),
+        'p90_ms': ms(percentile(timings, 90)),
+        'p99_ms': ms(percentile(timings, 99)),
+        'mean_ms': ms(sum(timings) / len(timings)) if timings else None,
+        'max_ms': ms(max(timings)) if timings else None,
+        'throughput_rps': round(len(results) / wall, 2) if wall else None,
+        'queries_per_request': round(queries / len(results), 2) if results else None,
+        'statuses': statuses,
+        # Прирост RSS за замер этого маршрута: наибольший и к концу замера, КБ
+        'rss_peak_growth_kb': rss[0],
+        'rss_end_growth_kb': rss[1],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='entard-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(args, workdir)
+
+    import entard
+    entard.create_app()
+    from sqlalchemy import event
+
+    started = time.perf_counter()
+    file_count, owned = seed(entard, args, rng)
+    seed_seconds = time.perf_counter() - started
+    print(f'Заполнено за {seed_seconds:.1f} с: {args.users} пользователей, {args.projects} проектов, '
+          f'{file_count} файлов', file=sys.stderr)
+
+    with entard.app.app_context():
+        counter = QueryCounter(entard.db.engine, event)
+        rows, cursor = entard.feed_page()
+    ctx = {'owned': owned, 'files': file_count, 'cursor': cursor or ''}
+
+    server = None
+    if args.server:
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        server = make_server('127.0.0.1', 0, entard.app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    for route in args.routes:
+        requests = build_requests(route, args, rng, ctx)
+        warmup, measured = requests[:args.warmup], requests[args.warmup:]
+        if server is not None:
+            run_server(entard, warmup, server.port, args.concurrency)
+        else:
+            run_test_client(entard, warmup)
+        counter.take()
+        with RssSampler() as rss:
+            start = time.perf_counter()
+            if server is not None:
+                timings = run_server(entard, measured, server.port, args.concurrency)
+            else:
+                timings = run_test_client(entard, measured)
+            wall = time.perf_counter() - start
+        summary = summarize(route, timings, wall, counter.take(), rss.growth(), args)
+        results.append(summary)
+        print(f"{route:>12}  p50 {summary['p50_ms']:>9.2f} мс  p99 {summary['p99_ms']:>9.2f} мс  "
+              f"{summary['throughput_rps']:>9.1f} rps  {summary['queries_per_request']:>6.1f} SQL/запрос  "
+              f"+{summary['rss_peak_growth_kb']} КБ RSS  {summary['statuses']}", file=sys.stderr)
+
+    if server is not None:
+        server.shutdown()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'mode': 'server' if args.server else 'test_client',
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'workdir', 'keep')},
+        'seed_seconds': round(seed_seconds, 3),
+        'results': results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if not args.keep and not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
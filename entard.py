@@ -1,22 +1,612 @@
 # entard.py - Соцсеть для проектов с загрузкой файлов
-from flask import Flask, render_template_string, request, redirect, url_for, flash, session, send_from_directory
+from flask import Flask, Request, Response, request, redirect, url_for, flash, session, send_file, abort, g, has_request_context
+from flask.cli import AppGroup
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from markupsafe import Markup
+from sqlalchemy import and_, or_, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, selectinload
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import atexit
+import click
+import codecs
+import collections
+import functools
+import gzip
+import hashlib
+import itertools
+import json
+import mmap
+import mimetypes
 import os
+import random
+import re
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 from werkzeug.utils import secure_filename
 
-app = Flask(__name__)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import TextLexer, get_lexer_for_filename
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'secret-key-entard'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///entard.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))  # 16MB
+# Размер блока записи загружаемых файлов на диск
+app.config['UPLOAD_CHUNK_SIZE'] = 64 * 1024
+# Возобновляемая загрузка: размер части (не больше MAX_CONTENT_LENGTH), предельный размер файла
+# и сколько секунд незавершённая загрузка живёт без новых частей до удаления в gc-blobs
+app.config['RESUMABLE_CHUNK_SIZE'] = int(os.environ.get('RESUMABLE_CHUNK_SIZE', 8 * 1024 * 1024))
+app.config['RESUMABLE_MAX_SIZE'] = int(os.environ.get('RESUMABLE_MAX_SIZE', 10 * 1024 ** 3))
+app.config['RESUMABLE_UPLOAD_TTL'] = int(os.environ.get('RESUMABLE_UPLOAD_TTL', 86400))
+# Через сколько секунд брошенную на середине запись части может перехватить повторный PUT
+app.config['RESUMABLE_CHUNK_TIMEOUT'] = int(os.environ.get('RESUMABLE_CHUNK_TIMEOUT', 300))
+app.config['FEED_PAGE_SIZE'] = int(os.environ.get('FEED_PAGE_SIZE', 24))
+# /api/v1: записей на страницу по умолчанию и наибольший limit (и число ids в одном запросе)
+app.config['API_PAGE_SIZE'] = int(os.environ.get('API_PAGE_SIZE', 50))
+app.config['API_MAX_PAGE_SIZE'] = int(os.environ.get('API_MAX_PAGE_SIZE', 200))
+# Тренды: период полураспада вклада звезды, как часто пересчитывать оценки (секунды), размер списка
+app.config['TRENDING_HALF_LIFE'] = float(os.environ.get('TRENDING_HALF_LIFE', 86400))
+app.config['TRENDING_DECAY_INTERVAL'] = float(os.environ.get('TRENDING_DECAY_INTERVAL', 3600))
+app.config['TRENDING_SIZE'] = int(os.environ.get('TRENDING_SIZE', 30))
+# Отдача файлов через фронтовой прокси: '' - сам Flask, 'x-accel' - nginx, 'x-sendfile' - Apache/lighttpd
+app.config['DOWNLOAD_OFFLOAD'] = os.environ.get('DOWNLOAD_OFFLOAD', '')
+# Внутренний location nginx, указывающий на UPLOAD_FOLDER
+app.config['DOWNLOAD_ACCEL_PREFIX'] = os.environ.get('DOWNLOAD_ACCEL_PREFIX', '/protected-uploads/')
+app.config['USE_X_SENDFILE'] = app.config['DOWNLOAD_OFFLOAD'] == 'x-sendfile'
+# Содержимое файла по id не меняется, поэтому браузер может долго держать его в кэше
+app.config['DOWNLOAD_MAX_AGE'] = int(os.environ.get('DOWNLOAD_MAX_AGE', 86400))
+# Предпросмотр файлов: байт на страницу, каталог и предельный размер кэша готового HTML,
+# стиль подсветки Pygments (подсветка - если установлен pygments)
+app.config['PREVIEW_PAGE_SIZE'] = int(os.environ.get('PREVIEW_PAGE_SIZE', 64 * 1024))
+app.config['PREVIEW_CACHE_DIR'] = os.environ.get('PREVIEW_CACHE_DIR', '')
+app.config['PREVIEW_CACHE_MAX_BYTES'] = int(os.environ.get('PREVIEW_CACHE_MAX_BYTES', 256 * 2**20))
+app.config['PREVIEW_STYLE'] = os.environ.get('PREVIEW_STYLE', 'github-dark')
+app.config['DOWNLOAD_LOOKUP_CACHE_SIZE'] = 4096
+# Степень сжатия архивов проекта (0-9)
+app.config['ARCHIVE_COMPRESSLEVEL'] = int(os.environ.get('ARCHIVE_COMPRESSLEVEL', 6))
+# Сжатие ответов: gzip всегда, brotli - если установлен пакет brotli
+app.config['COMPRESS_ENABLED'] = os.environ.get('COMPRESS_ENABLED', '1') == '1'
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+app.config['BROTLI_QUALITY'] = int(os.environ.get('BROTLI_QUALITY', 4))
+app.config['COMPRESS_CACHE_SIZE'] = int(os.environ.get('COMPRESS_CACHE_SIZE', 1000))
+# Статика с хешем в имени кэшируется браузером на год
+app.config['STATIC_MAX_AGE'] = int(os.environ.get('STATIC_MAX_AGE', 365 * 86400))
+# Кэш готовых страниц: LRU в памяти процесса и общее для всех воркеров хранилище SQLite,
+# через которое расходятся инвалидации (в том числе от `flask worker`). По умолчанию файл
+# .page_cache.sqlite в UPLOAD_FOLDER; пустая строка - только память процесса, тогда другие
+# процессы изменений не видят, и `flask serve` с несколькими воркерами кэш отключает
+app.config['PAGE_CACHE_ENABLED'] = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+app.config['PAGE_CACHE_SIZE'] = int(os.environ.get('PAGE_CACHE_SIZE', 1000))
+app.config['PAGE_CACHE_TTL'] = int(os.environ.get('PAGE_CACHE_TTL', 300))
+app.config['PAGE_CACHE_SHARED_PATH'] = os.environ.get('PAGE_CACHE_SHARED_PATH')
+app.config['PAGE_CACHE_SHARED_SIZE'] = int(os.environ.get('PAGE_CACHE_SHARED_SIZE', 20000))
+# Сколько секунд лента может отдаваться устаревшей, пока новая версия строится в фоне
+app.config['FEED_STALE_SECONDS'] = int(os.environ.get('FEED_STALE_SECONDS', 30))
+# Фоновые задачи: число потоков-обработчиков внутри веб-процесса (0 - только отдельный `flask worker`)
+app.config['JOB_INLINE_WORKERS'] = int(os.environ.get('JOB_INLINE_WORKERS', 2))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_RETRY_DELAY'] = float(os.environ.get('JOB_RETRY_DELAY', 5))  # секунды, удваивается с каждой попыткой
+app.config['JOB_RETRY_MAX_DELAY'] = float(os.environ.get('JOB_RETRY_MAX_DELAY', 600))
+# Обработчик раз в JOB_HEARTBEAT_INTERVAL секунд отмечает выполняемую задачу; задача без
+# отметки дольше JOB_TIMEOUT считается брошенной (упавший воркер)
+app.config['JOB_TIMEOUT'] = int(os.environ.get('JOB_TIMEOUT', 900))
+app.config['JOB_HEARTBEAT_INTERVAL'] = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 30))
+# Интервал сброса накопленных звёзд в БД (секунды); 0 - писать сразу
+app.config['STAR_FLUSH_INTERVAL'] = float(os.environ.get('STAR_FLUSH_INTERVAL', 2))
+
+# База данных: адрес, пул соединений и таймауты берутся из окружения
+app.config['DATABASE_URL'] = os.environ.get('DATABASE_URL', 'sqlite:///entard.db')
+# Реплика для чтения; если задана, страницы только для чтения идут на неё
+app.config['DATABASE_REPLICA_URL'] = os.environ.get('DATABASE_REPLICA_URL')
+# Сколько секунд после записи пользователь читает с основной базы (задержка репликации)
+app.config['DB_REPLICA_STICKY_SECONDS'] = float(os.environ.get('DB_REPLICA_STICKY_SECONDS', 5))
+app.config['DB_POOL_SIZE'] = os.environ.get('DB_POOL_SIZE')
+app.config['DB_MAX_OVERFLOW'] = os.environ.get('DB_MAX_OVERFLOW')
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['SQLITE_JOURNAL_MODE'] = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+app.config['SQLITE_SYNCHRONOUS'] = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # мс
+# Применять миграции схемы при импорте приложения
+app.config['AUTO_MIGRATE'] = os.environ.get('AUTO_MIGRATE', '1') == '1'
+# Инструментирование: время запросов, число и время SQL, журнал медленных запросов
+app.config['INSTRUMENTATION_ENABLED'] = os.environ.get('INSTRUMENTATION_ENABLED', '1') == '1'
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 500))
+app.config['SLOW_REQUEST_TOP_QUERIES'] = int(os.environ.get('SLOW_REQUEST_TOP_QUERIES', 5))
+# Сколько одинаковых SQL за запрос считать признаком N+1
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+# Если задан, /metrics требует заголовок Authorization: Bearer <токен>
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')
+# Production-сервер `flask serve`: процессы (0 - по числу доступных ядер) и потоки в каждом
+app.config['SERVE_HOST'] = os.environ.get('SERVE_HOST', '0.0.0.0')
+app.config['SERVE_PORT'] = int(os.environ.get('PORT', 5000))
+app.config['SERVE_WORKERS'] = int(os.environ.get('SERVE_WORKERS', 0))
+app.config['SERVE_THREADS'] = int(os.environ.get('SERVE_THREADS', 8))
+app.config['SERVE_BACKLOG'] = int(os.environ.get('SERVE_BACKLOG', 1024))
+# Сколько секунд воркеры дорабатывают текущие запросы при остановке
+app.config['SERVE_GRACEFUL_TIMEOUT'] = float(os.environ.get('SERVE_GRACEFUL_TIMEOUT', 30))
+# builtin - встроенный prefork-сервер, gunicorn - если установлен
+app.config['SERVE_RUNNER'] = os.environ.get('SERVE_RUNNER', 'builtin')
+# Сколько прокси стоит перед приложением (nginx и т.п.); нужно, чтобы видеть настоящий IP клиента
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+# Пароли: метод werkzeug с параметрами ('scrypt', 'pbkdf2:sha256:600000'), потоки и очередь хеширования
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 32))
+# Лимиты попыток "число/секунд"; пустая строка или 0 - без ограничения
+app.config['LOGIN_RATE_LIMIT_IP'] = os.environ.get('LOGIN_RATE_LIMIT_IP', '20/60')
+app.config['LOGIN_RATE_LIMIT_USER'] = os.environ.get('LOGIN_RATE_LIMIT_USER', '5/60')
+app.config['REGISTER_RATE_LIMIT_IP'] = os.environ.get('REGISTER_RATE_LIMIT_IP', '10/600')
+# Файл SQLite для лимитов, общих для всех воркеров; пусто - в памяти каждого процесса
+app.config['RATE_LIMIT_SHARED_PATH'] = os.environ.get('RATE_LIMIT_SHARED_PATH', '')
+# Кэш пользователей в памяти процесса: размер и время жизни записи (секунды)
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 300))
+
+# Файл настроек (python) поверх значений по умолчанию и окружения
+app.config.from_envvar('ENTARD_CONFIG', silent=True)
+
+def normalize_database_url(url):
+    # Heroku и подобные отдают postgres://, SQLAlchemy ожидает postgresql://
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def engine_options(url):
+    config = app.config
+    if url.startswith('sqlite'):
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            return {}
+        return {
+            'pool_size': int(config['DB_POOL_SIZE'] or 5),
+            'max_overflow': int(config['DB_MAX_OVERFLOW'] or 10),
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000},
+        }
+    # PostgreSQL и прочие серверные базы: проверка соединений и LIFO, чтобы лишние
+    # соединения закрывались по таймауту простоя
+    return {
+        'pool_size': int(config['DB_POOL_SIZE'] or 10),
+        'max_overflow': int(config['DB_MAX_OVERFLOW'] or 20),
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+        'pool_use_lifo': True,
+    }
+
+def configure_database():
+    url = normalize_database_url(app.config['DATABASE_URL'])
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(url)
+    binds = {}
+    if app.config['DATABASE_REPLICA_URL']:
+        replica_url = normalize_database_url(app.config['DATABASE_REPLICA_URL'])
+        binds['replica'] = {'url': replica_url, **engine_options(replica_url)}
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+configure_database()
+
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                            x_proto=app.config['TRUSTED_PROXIES'], x_host=app.config['TRUSTED_PROXIES'])
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL позволяет читателям не ждать писателей; NORMAL в режиме WAL безопасен
+    # и не делает fsync на каждый коммит
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    cursor.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.close()
+
+# Сессия, которая отправляет чтения страниц из read_only_route на реплику
+class RoutingSession(FlaskSession):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_request_context()
+                and g.get('use_replica') and 'replica' in self._db.engines):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+def read_only_route(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_replica = session.get('primary_until', 0) < time.time()
+        return view(*args, **kwargs)
+    return wrapper
+
+@event.listens_for(RoutingSession, 'after_flush')
+def remember_write(db_session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+@app.after_request
+def stick_to_primary(response):
+    # После записи ненадолго читаем с основной базы, чтобы пользователь видел свои изменения
+    if g.get('db_wrote') and app.config['DATABASE_REPLICA_URL']:
+        session['primary_until'] = time.time() + app.config['DB_REPLICA_STICKY_SECONDS']
+    return response
+
+# Потокобезопасный LRU-кэш в памяти процесса
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            return self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+# Статика и сжатие ответов. Файлы из static/ отдаются под именами с хешем содержимого
+# (entard.3f2a9c1b7d4e.css) с кэшированием на год: новая версия файла - новое имя.
+# Bootstrap 5.1.3 (с Popper 2.10.2) и Bootstrap Icons 1.11.1 лежат в static/vendor вместе
+# с остальной статикой, внешние CDN страницам не нужны. bootstrap-icons.css ссылается на
+# шрифты по именам с хешем: при замене шрифтов хеши в нём нужно обновить. Сжатые варианты
+# (.gz, .br) готовит `flask build-assets`, без них файл сжимается при первом запросе
+# и хранится в памяти.
+STATIC_FOLDER = os.path.join(app.root_path, 'static')
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+HASHED_NAME_RE = re.compile(r'^(.+)\.([0-9a-f]{12})(\.[^./]+)$')
+
+def available_encodings():
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def compress(data, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else app.config['BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=9 if best else app.config['COMPRESS_LEVEL'], mtime=0)
+
+def is_compressible(mimetype):
+    return mimetype is not None and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+@functools.lru_cache(maxsize=1)
+def static_manifest():
+    # Логическое имя -> (хеш содержимого, путь); строится один раз на процесс
+    manifest = {}
+    for dirpath, _, filenames in os.walk(STATIC_FOLDER):
+        for name in filenames:
+            if name.endswith(('.gz', '.br')):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            manifest[os.path.relpath(path, STATIC_FOLDER).replace(os.sep, '/')] = (digest, path)
+    return manifest
+
+def static_url(name):
+    entry = static_manifest().get(name)
+    if entry is None:
+        return f'/static/{name}'
+    base, ext = os.path.splitext(name)
+    return f'/static/{base}.{entry[0][:12]}{ext}'
+
+app.jinja_env.globals['static_url'] = static_url
+
+# Сжатые в памяти версии статики: (путь, хеш, кодировка) -> байты
+compressed_static = LRUCache(256)
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    match = HASHED_NAME_RE.match(filename)
+    name = match.group(1) + match.group(3) if match else filename
+    entry = static_manifest().get(name)
+    if entry is None:
+        abort(404)
+    digest, path = entry
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    # Имя с актуальным хешем не меняется никогда; остальное - с проверкой ETag
+    immutable = match is not None and digest.startswith(match.group(2))
+    encoding = None
+    if is_compressible(mimetype):
+        encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=digest)
+    else:
+        etag = f'{digest}-{encoding}'
+        suffix = '.br' if encoding == 'br' else '.gz'
+        if os.path.exists(path + suffix) and os.path.getmtime(path + suffix) >= os.path.getmtime(path):
+            response = send_file(path + suffix, mimetype=mimetype, conditional=True, etag=etag)
+        else:
+            body = compressed_static.get((path, digest, encoding))
+            if body is None:
+                with open(path, 'rb') as f:
+                    body = compress(f.read(), encoding, best=True)
+                compressed_static.set((path, digest, encoding), body)
+            response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.make_conditional(request)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    if immutable:
+        # send_file без max_age ставит no-cache, для неизменяемого имени он не нужен
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+# HTML-страницы получают слабый ETag по содержимому (повторный запрос с If-None-Match -
+# 304 без тела), текстовые ответы сжимаются gzip или brotli. Сжатые версии страниц
+# запоминаются по ETag, поэтому страница из кэша страниц не сжимается заново.
+compressed_pages = LRUCache(app.config['COMPRESS_CACHE_SIZE'])
+
+# Окончательный статус ответа для метрик (см. finish_request_stats). Хуки after_request
+# выполняются в обратном порядке регистрации, поэтому этот, зарегистрированный раньше
+# compress_response, видит ответ уже после make_conditional (304)
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or request.method not in ('GET', 'HEAD', 'POST')
+            or 'Content-Encoding' in response.headers or not is_compressible(response.mimetype)):
+        return response
+    if request.method in ('GET', 'HEAD') and response.status_code == 200 and response.mimetype == 'text/html':
+        response.add_etag(weak=True)
+        if 'Cache-Control' not in response.headers:
+            response.cache_control.no_cache = True
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    if not app.config['COMPRESS_ENABLED'] or response.status_code < 200 or response.status_code == 204:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+    etag = response.get_etag()[0]
+    body = compressed_pages.get((etag, encoding)) if etag else None
+    if body is None:
+        body = compress(data, encoding)
+        if etag:
+            compressed_pages.set((etag, encoding), body)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# Инструментирование запросов. События движка засекают каждый SQL, хуки Flask собирают
+# статистику запроса в g.request_stats; одинаковые SQL, повторённые много раз за запрос,
+# - признак N+1 (ленивая загрузка в цикле). Счётчики для /metrics хранятся в памяти
+# процесса, при нескольких воркерах Prometheus собирает их с каждого отдельно.
+IN_LIST_RE = re.compile(r'\bIN\s*\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def sql_pattern(statement):
+    # Списки IN (?, ?, ?) разной длины сводим к одному шаблону
+    return IN_LIST_RE.sub('IN (?)', WHITESPACE_RE.sub(' ', statement).strip())
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.patterns = {}  # шаблон SQL -> [число выполнений, суммарное время]
+
+    def add_query(self, statement, duration):
+        self.sql_count += 1
+        self.sql_time += duration
+        entry = self.patterns.get(statement)
+        if entry is None:
+            self.patterns[statement] = [1, duration]
+        else:
+            entry[0] += 1
+            entry[1] += duration
+
+    def top_queries(self, limit):
+        grouped = {}
+        for statement, (count, total) in self.patterns.items():
+            entry = grouped.setdefault(sql_pattern(statement), [0, 0.0])
+            entry[0] += count
+            entry[1] += total
+        return sorted(grouped.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+
+    def duplicates(self, threshold):
+        return [(pattern, count) for pattern, (count, total) in self.top_queries(len(self.patterns))
+                if count >= threshold]
+
+def current_request_stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_request_stats() is not None:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    stats = current_request_stats()
+    started = conn.info.get('query_started')
+    if stats is not None and started:
+        stats.add_query(statement, time.perf_counter() - started.pop())
+
+@event.listens_for(Engine, 'handle_error')
+def drop_query_timer(exception_context):
+    started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+# Счётчики в формате Prometheus: метрика -> {метки: значение}
+class Metrics:
+    DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(lambda: collections.defaultdict(float))
+        self.histograms = {}  # метки -> [счётчики по корзинам, сумма, число]
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[name][labels] += value
+
+    def observe(self, labels, value):
+        with self.lock:
+            histogram = self.histograms.get(labels)
+            if histogram is None:
+                histogram = self.histograms[labels] = [[0] * len(self.DURATION_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
 
-# Создаем папки для загрузок
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    def record_request(self, endpoint, method, status, stats, duration, slow, n_plus_one):
+        self.inc('entard_http_requests_total', (('endpoint', endpoint), ('method', method), ('status', str(status))))
+        self.observe((('endpoint', endpoint),), duration)
+        labels = (('endpoint', endpoint),)
+        self.inc('entard_sql_queries_total', labels, stats.sql_count)
+        self.inc('entard_sql_duration_seconds_total', labels, stats.sql_time)
+        if slow:
+            self.inc('entard_slow_requests_total', labels)
+        if n_plus_one:
+            self.inc('entard_n_plus_one_requests_total', labels)
 
-db = SQLAlchemy(app)
+    HELP = {
+        'entard_http_requests_total': ('counter', 'Обработанные HTTP-запросы'),
+        'entard_sql_queries_total': ('counter', 'SQL-запросы, выполненные при обработке HTTP-запросов'),
+        'entard_sql_duration_seconds_total': ('counter', 'Суммарное время SQL при обработке HTTP-запросов'),
+        'entard_slow_requests_total': ('counter', 'Запросы дольше SLOW_REQUEST_MS'),
+        'entard_n_plus_one_requests_total': ('counter', 'Запросы с повторяющимися SQL (N+1)'),
+        'entard_page_cache_total': ('counter', 'Ответы из кэша страниц по результату'),
+    }
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, text) in self.HELP.items():
+                values = self.counters.get(name)
+                if not values:
+                    continue
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in sorted(values.items()):
+                    lines.append(f'{name}{format_labels(labels)} {value:g}')
+            if self.histograms:
+                name = 'entard_http_request_duration_seconds'
+                lines.append(f'# HELP {name} Время обработки HTTP-запросов')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, (buckets, total, count) in sorted(self.histograms.items()):
+                    for bound, bucket in zip(self.DURATION_BUCKETS, buckets):
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", f"{bound:g}"),))} {bucket}')
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {total:g}')
+                    lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+metrics = Metrics()
+
+@app.before_request
+def start_request_stats():
+    if app.config['INSTRUMENTATION_ENABLED']:
+        g.request_stats = RequestStats()
+
+@app.after_request
+def add_server_timing(response):
+    stats = g.get('request_stats')
+    if stats is not None:
+        elapsed = (time.perf_counter() - stats.started) * 1000
+        response.headers['Server-Timing'] = (
+            f'app;dur={elapsed:.1f}, db;dur={stats.sql_time * 1000:.1f};desc="{stats.sql_count} SQL"')
+        if 'X-Cache' in response.headers:
+            metrics.inc('entard_page_cache_total', (('result', response.headers['X-Cache']),))
+    return response
+
+@app.teardown_request
+def finish_request_stats(exc):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return
+    duration = time.perf_counter() - stats.started
+    status = 500 if exc is not None else g.get('response_status', 500)
+    endpoint = request.endpoint or 'unknown'
+    slow = duration * 1000 >= app.config['SLOW_REQUEST_MS']
+    duplicates = stats.duplicates(app.config['N_PLUS_ONE_THRESHOLD'])
+    metrics.record_request(endpoint, request.method, status, stats, duration, slow, bool(duplicates))
+    for pattern, count in duplicates:
+        app.logger.warning('Возможный N+1 в %s %s: %d повторов %s', request.method, request.path, count, pattern)
+    if slow:
+        top = stats.top_queries(app.config['SLOW_REQUEST_TOP_QUERIES'])
+        app.logger.warning(
+            'Медленный запрос %s %s: %.0f мс, %d SQL за %.0f мс%s', request.method, request.full_path.rstrip('?'),
+            duration * 1000, stats.sql_count, stats.sql_time * 1000,
+            ''.join(f'\n  {total * 1000:.1f} мс, {count}x: {pattern}' for pattern, (count, total) in top))
+
+# Метрики для Prometheus
+@app.route('/metrics')
+def metrics_endpoint():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # Модели
 class User(db.Model):
@@ -25,7 +615,10 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(200), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    projects = db.relationship('Project', backref='author', lazy=True)
+    # Версия строки для ETag в /api/v1, см. bump_row_version
+    row_version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    projects = db.relationship('Project', back_populates='author', lazy=True)
 
 class Project(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -33,63 +626,1003 @@ class Project(db.Model):
     description = db.Column(db.Text, nullable=False)
     repository_url = db.Column(db.String(500))
     languages = db.Column(db.Text)
+    # Разбивка по языкам определяется по файлам, а не вводится вручную
+    languages_auto = db.Column(db.Boolean, nullable=False, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     stars = db.Column(db.Integer, default=0)
+    # Затухающая сумма звёзд для /trending, см. TrendingState
+    trending_score = db.Column(db.Float, nullable=False, default=0)
     files_folder = db.Column(db.String(200))
+    # Версия строки для ETag в /api/v1; файлы проекта версионируются вместе с проектом
+    row_version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    author = db.relationship('User', back_populates='projects')
+    __table_args__ = (
+        db.Index('ix_project_created_id', 'created_at', 'id'),
+        db.Index('ix_project_user_created', 'user_id', 'created_at'),
+        db.Index('ix_project_trending', 'trending_score', 'id'),
+    )
+    language_stats = db.relationship('ProjectLanguage', order_by='ProjectLanguage.position',
+                                     cascade='all, delete-orphan', lazy=True)
 
 class ProjectFile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(200), nullable=False)
     filepath = db.Column(db.String(500), nullable=False)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
+    size = db.Column(db.BigInteger)
+    sha256 = db.Column(db.String(64))
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'))
+    # Язык файла: NULL - ещё не определялся, '' - не язык программирования
+    language = db.Column(db.String(50))
     project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
     project = db.relationship('Project', backref='files')
+    __table_args__ = (
+        db.Index('ix_project_file_project_id', 'project_id', 'id'),
+        db.Index('ix_project_file_blob_sha256', 'blob_sha256'),
+    )
 
-# Создаем таблицы
-with app.app_context():
-    db.create_all()
+# Разобранная строка Project.languages: одна строка на язык, заполняется при записи
+class ProjectLanguage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False, index=True)
+    name = db.Column(db.String(50), nullable=False, index=True)
+    percent = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
 
-# HTML шаблон
-def render_page(title, content):
-    auth_buttons = ""
-    if 'user_id' in session:
-        auth_buttons = f'''
-        <a href="/create" class="btn btn-primary me-2">
-            <i class="bi bi-plus-lg"></i> Новый проект
-        </a>
-        <a href="/profile" class="btn btn-outline-light me-2">
-            <i class="bi bi-person-circle"></i> {session['username']}
-        </a>
-        <a href="/logout" class="btn btn-outline-danger">Выйти</a>
-        '''
+    @property
+    def color(self):
+        return language_color(self.name)
+
+# Содержимое файлов хранится один раз по SHA-256; refcount - число ссылок из ProjectFile
+class Blob(db.Model):
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Очередь фоновых задач: строка создаётся в той же транзакции, что и данные, которые
+# задача обрабатывает, поэтому задача не теряется и не видит незакоммиченных данных
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'),)
+
+class ProjectStar(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'project_id'),
+        db.Index('ix_project_star_created_at', 'created_at'),
+    )
+
+# Оценка тренда: каждая звезда добавляет проекту 2^((t - epoch) / TRENDING_HALF_LIFE), где
+# epoch - общая точка отсчёта. Новые звёзды весят больше старых, поэтому порядок по оценке -
+# это порядок по затухающей сумме звёзд, и при звезде меняется только одна строка. Чтобы
+# числа не росли бесконечно, decay_trending периодически переносит epoch на текущее время
+# и умножает все оценки на одинаковый множитель - порядок от этого не меняется.
+class TrendingState(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    epoch = db.Column(db.Float, nullable=False)  # unix time
+
+# Счётчики пользователя для профиля. Обновляются в тех же транзакциях, что и данные,
+# поэтому профилю не нужно пересчитывать проекты, звёзды и файлы автора
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    project_count = db.Column(db.Integer, nullable=False, default=0)
+    star_count = db.Column(db.Integer, nullable=False, default=0)
+    file_count = db.Column(db.Integer, nullable=False, default=0)
+
+def user_stats_select():
+    # Те же счётчики, посчитанные по данным; коррелированы с User.id внешнего запроса
+    projects = db.select(db.func.count()).where(Project.user_id == User.id).scalar_subquery()
+    stars = (db.select(db.func.coalesce(db.func.sum(Project.stars), 0))
+             .where(Project.user_id == User.id).scalar_subquery())
+    files = (db.select(db.func.count()).select_from(ProjectFile)
+             .join(Project, Project.id == ProjectFile.project_id)
+             .where(Project.user_id == User.id).scalar_subquery())
+    return db.select(User.id, projects.label('project_count'), stars.label('star_count'),
+                     files.label('file_count'))
+
+def recount_user_stats(conn, user_ids=None):
+    users = user_stats_select()
+    delete = UserStats.__table__.delete()
+    if user_ids is not None:
+        users = users.where(User.id.in_(user_ids))
+        delete = delete.where(UserStats.user_id.in_(user_ids))
+    conn.execute(delete)
+    conn.execute(UserStats.__table__.insert().from_select(
+        ['user_id', 'project_count', 'star_count', 'file_count'], users))
+
+def bump_user_stats(conn, user_id, projects=0, files=0):
+    conn.execute(UserStats.__table__.update().where(UserStats.user_id == user_id).values(
+        project_count=UserStats.project_count + projects,
+        file_count=UserStats.file_count + files,
+    ))
+
+# Любая запись, меняющая поля, которые отдаёт /api/v1, увеличивает версию строки: по ней
+# строятся ETag и Last-Modified. Изменение файлов проекта увеличивает версию проекта.
+# trending_score в API не отдаётся, поэтому decay_trending версии не трогает
+def bump_row_version(conn, model, ids):
+    conn.execute(db.update(model).where(model.id.in_(ids)).values(
+        row_version=model.row_version + 1, updated_at=datetime.utcnow()))
+
+# Возобновляемая загрузка большого файла по частям. Части пишутся сразу на своё место
+# в файле .resumable/<id>, принятые части с их хешами записываются в upload_chunk
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    # Ожидаемый хеш всего файла от клиента (необязательный) и посчитанный при сборке
+    sha256 = db.Column(db.String(64))
+    blob_sha256 = db.Column(db.String(64))
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, finalizing, done, failed
+    error = db.Column(db.Text)
+    file_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadChunk(db.Model):
+    upload_id = db.Column(db.String(32), db.ForeignKey('upload_session.id'), primary_key=True)
+    number = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    # writing — часть пишется запросом с меткой token, received — записана и проверена
+    status = db.Column(db.String(20), nullable=False, default='received', server_default='received')
+    token = db.Column(db.String(32))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Позиция импорта `flask data import`: последняя закоммиченная строка файла
+class ImportCheckpoint(db.Model):
+    source = db.Column(db.String(500), primary_key=True)
+    line = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Полнотекстовый индекс SQLite FTS5 по названию и описанию; триггеры обновляют его
+# при каждой вставке, изменении и удалении проекта
+SEARCH_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE project_fts USING fts5(title, description, content='project', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS project_fts_insert AFTER INSERT ON project BEGIN
+        INSERT INTO project_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS project_fts_delete AFTER DELETE ON project BEGIN
+        INSERT INTO project_fts(project_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS project_fts_update AFTER UPDATE OF title, description ON project BEGIN
+        INSERT INTO project_fts(project_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO project_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+def search_index_enabled():
+    return db.engine.dialect.name == 'sqlite'
+
+def init_search_index(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    exists = conn.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'project_fts'"
+    )).first()
+    if exists:
+        return
+    for statement in SEARCH_INDEX_DDL:
+        conn.execute(db.text(statement))
+    # Индексируем проекты, созданные до появления поиска
+    conn.execute(db.text("INSERT INTO project_fts(project_fts) VALUES ('rebuild')"))
+
+def drop_search_index(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    for trigger in ('project_fts_insert', 'project_fts_delete', 'project_fts_update'):
+        conn.execute(db.text(f'DROP TRIGGER IF EXISTS {trigger}'))
+    conn.execute(db.text('DROP TABLE IF EXISTS project_fts'))
+
+# Миграции схемы. db.create_all() создаёт только недостающие таблицы, поэтому изменения
+# существующих таблиц описываются здесь: каждая миграция идемпотентна и умеет откатываться.
+# Номер последней применённой миграции хранится в таблице schema_migrations.
+def add_column_if_missing(conn, column):
+    existing = {c['name'] for c in db.inspect(conn).get_columns(column.table.name)}
+    if column.name not in existing:
+        # Имя таблицы в кавычках: "user" - зарезервированное слово в PostgreSQL
+        table = conn.dialect.identifier_preparer.format_table(column.table)
+        column_type = column.type.compile(conn.dialect)
+        conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {column.name} {column_type}'))
+
+# Строки project_language для проектов, у которых есть только текст Project.languages.
+# Возвращает (последний id, число заполненных проектов) или None, если проектов не осталось
+def backfill_languages_batch(conn, last_id, batch_size):
+    has_stats = db.select(ProjectLanguage.id).where(ProjectLanguage.project_id == Project.id).exists()
+    projects = conn.execute(
+        db.select(Project.id, Project.languages)
+        .where(Project.id > last_id, Project.languages.isnot(None), ~has_stats)
+        .order_by(Project.id).limit(batch_size)
+    ).all()
+    if not projects:
+        return None
+    languages, texts = [], []
+    for project in projects:
+        pairs = parse_languages(project.languages, strict=False)
+        if not pairs:
+            continue
+        languages.extend({'project_id': project.id, 'name': name, 'percent': percent, 'position': position}
+                         for position, (name, percent) in enumerate(pairs))
+        if format_languages(pairs) != project.languages:
+            texts.append({'project_id': project.id, 'text': format_languages(pairs)})
+    if languages:
+        conn.execute(ProjectLanguage.__table__.insert(), languages)
+    if texts:
+        # Текст приводится к разобранному виду, как при set_project_languages
+        table = Project.__table__
+        conn.execute(
+            table.update().where(table.c.id == db.bindparam('project_id')).values(
+                languages=db.bindparam('text'), row_version=table.c.row_version + 1,
+                updated_at=datetime.utcnow()),
+            texts,
+        )
+    return projects[-1].id, len({row['project_id'] for row in languages})
+
+def upgrade_0001(conn):
+    for column in (ProjectFile.size, ProjectFile.sha256, ProjectFile.blob_sha256):
+        add_column_if_missing(conn, column.expression)
+
+HOT_PATH_INDEXES = [
+    index for table in (Project.__table__, ProjectFile.__table__)
+    for index in table.indexes
+    if index.name in ('ix_project_created_id', 'ix_project_user_created',
+                      'ix_project_file_project_id', 'ix_project_file_blob_sha256')
+]
+TRENDING_INDEXES = [
+    index for table in (Project.__table__, ProjectStar.__table__)
+    for index in table.indexes if index.name in ('ix_project_trending', 'ix_project_star_created_at')
+]
+
+def drop_column_if_exists(conn, column):
+    existing = {c['name'] for c in db.inspect(conn).get_columns(column.table.name)}
+    if column.name in existing:
+        table = conn.dialect.identifier_preparer.format_table(column.table)
+        conn.execute(db.text(f'ALTER TABLE {table} DROP COLUMN {column.name}'))
+
+def upgrade_0002(conn):
+    for index in HOT_PATH_INDEXES:
+        index.create(conn, checkfirst=True)
+
+def downgrade_0002(conn):
+    for index in HOT_PATH_INDEXES:
+        index.drop(conn, checkfirst=True)
+
+def upgrade_0004(conn):
+    add_column_if_missing(conn, ProjectFile.language.expression)
+    add_column_if_missing(conn, Project.languages_auto.expression)
+    conn.execute(db.text('UPDATE project SET languages_auto = 0 WHERE languages_auto IS NULL'))
+
+def downgrade_0004(conn):
+    drop_column_if_exists(conn, Project.languages_auto.expression)
+    drop_column_if_exists(conn, ProjectFile.language.expression)
+
+def upgrade_0005(conn):
+    UserStats.__table__.create(conn, checkfirst=True)
+    recount_user_stats(conn)
+
+def downgrade_0005(conn):
+    UserStats.__table__.drop(conn, checkfirst=True)
+
+def upgrade_0006(conn):
+    UploadSession.__table__.create(conn, checkfirst=True)
+    UploadChunk.__table__.create(conn, checkfirst=True)
+
+def downgrade_0006(conn):
+    UploadChunk.__table__.drop(conn, checkfirst=True)
+    UploadSession.__table__.drop(conn, checkfirst=True)
+
+def upgrade_0007(conn):
+    add_column_if_missing(conn, Project.trending_score.expression)
+    conn.execute(db.text('UPDATE project SET trending_score = 0 WHERE trending_score IS NULL'))
+    TrendingState.__table__.create(conn, checkfirst=True)
+    for index in TRENDING_INDEXES:
+        index.create(conn, checkfirst=True)
+    rebuild_trending(conn)
+
+def downgrade_0007(conn):
+    for index in TRENDING_INDEXES:
+        index.drop(conn, checkfirst=True)
+    TrendingState.__table__.drop(conn, checkfirst=True)
+    drop_column_if_exists(conn, Project.trending_score.expression)
+
+def upgrade_0008(conn):
+    for model in (User, Project):
+        add_column_if_missing(conn, model.row_version.expression)
+        add_column_if_missing(conn, model.updated_at.expression)
+        conn.execute(db.update(model).where(model.row_version.is_(None)).values(row_version=1))
+        conn.execute(db.update(model).where(model.updated_at.is_(None)).values(updated_at=model.created_at))
+
+def downgrade_0008(conn):
+    for model in (Project, User):
+        drop_column_if_exists(conn, model.updated_at.expression)
+        drop_column_if_exists(conn, model.row_version.expression)
+
+def upgrade_0010(conn):
+    last_id = 0
+    while True:
+        batch = backfill_languages_batch(conn, last_id, 500)
+        if batch is None:
+            break
+        last_id = batch[0]
+
+def downgrade_0010(conn):
+    # Заполненные строки соответствуют Project.languages, удалять их незачем
+    pass
+
+def upgrade_0009(conn):
+    ImportCheckpoint.__table__.create(conn, checkfirst=True)
+
+def downgrade_0009(conn):
+    ImportCheckpoint.__table__.drop(conn, checkfirst=True)
+
+def upgrade_0011(conn):
+    for column in (UploadChunk.status, UploadChunk.token, UploadChunk.updated_at):
+        add_column_if_missing(conn, column.expression)
+    conn.execute(db.update(UploadChunk).where(UploadChunk.status.is_(None)).values(status='received'))
+
+def downgrade_0011(conn):
+    for column in (UploadChunk.updated_at, UploadChunk.token, UploadChunk.status):
+        drop_column_if_exists(conn, column.expression)
+
+MIGRATIONS = [
+    # SQLite не умеет удалять колонки с внешним ключом, поэтому первая миграция необратима
+    (1, 'Размер, хеш и блоб у файлов проекта', upgrade_0001, None),
+    (2, 'Индексы ленты, профиля и списка файлов', upgrade_0002, downgrade_0002),
+    (3, 'Полнотекстовый индекс проектов', init_search_index, drop_search_index),
+    (4, 'Автоматическое определение языков', upgrade_0004, downgrade_0004),
+    (5, 'Счётчики пользователей', upgrade_0005, downgrade_0005),
+    (6, 'Возобновляемая загрузка файлов', upgrade_0006, downgrade_0006),
+    (7, 'Оценки трендов', upgrade_0007, downgrade_0007),
+    (8, 'Версии строк для API', upgrade_0008, downgrade_0008),
+    (9, 'Позиции импорта данных', upgrade_0009, downgrade_0009),
+    (10, 'Заполнение таблицы языков', upgrade_0010, downgrade_0010),
+    (11, 'Состояние частей загрузки', upgrade_0011, downgrade_0011),
+]
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.String(200), nullable=False),
+    db.Column('applied_at', db.DateTime, default=datetime.utcnow),
+)
+
+def schema_version(conn):
+    return conn.execute(db.select(db.func.max(schema_migrations.c.version))).scalar() or 0
+
+def begin_migration(conn):
+    # pysqlite не открывает транзакцию перед DDL; BEGIN IMMEDIATE делает миграцию
+    # атомарной и не даёт двум процессам мигрировать одновременно
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+
+def upgrade_schema(target=None):
+    target = MIGRATIONS[-1][0] if target is None else target
+    applied = []
+    with db.engine.begin() as conn:
+        begin_migration(conn)
+        current = schema_version(conn)
+        for version, name, upgrade, _ in MIGRATIONS:
+            if current < version <= target:
+                upgrade(conn)
+                conn.execute(schema_migrations.insert().values(
+                    version=version, name=name, applied_at=datetime.utcnow()))
+                applied.append((version, name))
+    return applied
+
+def downgrade_schema(target):
+    reverted = []
+    with db.engine.begin() as conn:
+        begin_migration(conn)
+        current = schema_version(conn)
+        for version, name, _, downgrade in reversed(MIGRATIONS):
+            if target < version <= current:
+                if downgrade is None:
+                    raise click.ClickException(f'Миграцию {version:04d} нельзя откатить')
+                downgrade(conn)
+                conn.execute(schema_migrations.delete().where(schema_migrations.c.version == version))
+                reverted.append((version, name))
+    return reverted
+
+# Однократная инициализация хранилища: папка загрузок, таблицы и миграции. `flask serve`
+# выполняет её в главном процессе до запуска воркеров, и воркеры схему уже не трогают;
+# при `flask run` или импорте модуля - при первом запросе
+storage_ready = threading.Event()
+storage_lock = threading.Lock()
+
+def init_storage():
+    if storage_ready.is_set():
+        return
+    with storage_lock:
+        if storage_ready.is_set():
+            return
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        if pygments is None:
+            app.logger.warning('Pygments не установлен: просмотр файлов будет без подсветки синтаксиса')
+        with app.app_context():
+            db.create_all()
+            if app.config['AUTO_MIGRATE']:
+                upgrade_schema()
+        storage_ready.set()
+
+@app.before_request
+def ensure_storage():
+    init_storage()
+
+# Фабрика приложения для WSGI-серверов: gunicorn 'entard:create_app()'.
+# Настройки читаются из окружения и ENTARD_CONFIG при импорте модуля
+def create_app():
+    init_storage()
+    return app
+
+# INSERT, пропускающий строки с конфликтом уникального ключа
+def insert_ignore(table):
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
     else:
-        auth_buttons = '''
-        <a href="/login" class="btn btn-outline-light me-2">Войти</a>
-        <a href="/register" class="btn btn-primary">Регистрация</a>
-        '''
-    
-    base_html = f'''
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table).on_conflict_do_nothing()
+
+# Языки проекта: разбор и проверка строки "Python:60, JavaScript:30" при записи
+LANGUAGE_COLORS = {
+    'python': '#3572A5',
+    'javascript': '#f1e05a',
+    'typescript': '#3178c6',
+    'html': '#e34c26',
+    'css': '#563d7c',
+    'java': '#b07219',
+    'c': '#555555',
+    'c++': '#f34b7d',
+    'c#': '#178600',
+    'go': '#00ADD8',
+    'rust': '#dea584',
+    'ruby': '#701516',
+    'php': '#4F5D95',
+    'kotlin': '#A97BFF',
+    'swift': '#F05138',
+    'shell': '#89e051',
+    'sql': '#e38c00',
+    'lua': '#000080',
+    'dart': '#00B4AB',
+    'scala': '#c22d40',
+}
+
+@functools.lru_cache(maxsize=1024)
+def language_color(name):
+    # hash() рандомизируется между процессами, поэтому цвет берём от md5 имени
+    key = name.strip().lower()
+    if key in LANGUAGE_COLORS:
+        return LANGUAGE_COLORS[key]
+    hue = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16) % 360
+    return f"hsl({hue}, 70%, 50%)"
+
+def parse_languages(text, strict=True):
+    # Возвращает список (язык, процент); в строгом режиме ошибки формата - ValueError
+    result = []
+    seen = set()
+    for part in (text or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            name, perc = part.rsplit(':', 1)
+            name = name.strip()
+            perc = round(float(perc))
+            if not name or len(name) > 50 or not 0 <= perc <= 100 or name.lower() in seen:
+                raise ValueError(part)
+        except ValueError:
+            if strict:
+                raise ValueError(f'Неверный формат языка: {part}')
+            continue
+        seen.add(name.lower())
+        result.append((name, perc))
+    if strict and sum(perc for _, perc in result) > 100:
+        raise ValueError('Сумма процентов языков больше 100')
+    return result
+
+def format_languages(pairs):
+    return ', '.join(f'{name}:{perc}' for name, perc in pairs)
+
+def set_project_languages(project, pairs):
+    project.languages = format_languages(pairs)
+    project.language_stats = [
+        ProjectLanguage(name=name, percent=perc, position=position)
+        for position, (name, perc) in enumerate(pairs)
+    ]
+
+# Определение языков по загруженным файлам: язык берётся по расширению или имени файла,
+# для файлов без расширения - по первой строке (#!). Вес языка - суммарный размер файлов,
+# поэтому содержимое файлов целиком не читается
+EXTENSION_LANGUAGES = {
+    '.py': 'Python', '.pyw': 'Python', '.pyi': 'Python',
+    '.js': 'JavaScript', '.mjs': 'JavaScript', '.cjs': 'JavaScript', '.jsx': 'JavaScript',
+    '.ts': 'TypeScript', '.tsx': 'TypeScript',
+    '.html': 'HTML', '.htm': 'HTML',
+    '.css': 'CSS', '.scss': 'SCSS', '.sass': 'Sass', '.less': 'Less',
+    '.java': 'Java', '.kt': 'Kotlin', '.kts': 'Kotlin', '.scala': 'Scala', '.groovy': 'Groovy',
+    '.c': 'C', '.h': 'C',
+    '.cc': 'C++', '.cpp': 'C++', '.cxx': 'C++', '.hpp': 'C++', '.hh': 'C++', '.hxx': 'C++',
+    '.cs': 'C#', '.fs': 'F#', '.vb': 'Visual Basic',
+    '.go': 'Go', '.rs': 'Rust', '.swift': 'Swift', '.m': 'Objective-C', '.mm': 'Objective-C',
+    '.rb': 'Ruby', '.php': 'PHP', '.pl': 'Perl', '.pm': 'Perl', '.lua': 'Lua', '.r': 'R',
+    '.dart': 'Dart', '.ex': 'Elixir', '.exs': 'Elixir', '.erl': 'Erlang', '.hs': 'Haskell',
+    '.clj': 'Clojure', '.ml': 'OCaml', '.jl': 'Julia', '.zig': 'Zig', '.nim': 'Nim',
+    '.sh': 'Shell', '.bash': 'Shell', '.zsh': 'Shell', '.ps1': 'PowerShell', '.bat': 'Batchfile',
+    '.sql': 'SQL', '.vue': 'Vue', '.svelte': 'Svelte', '.ipynb': 'Jupyter Notebook',
+    '.asm': 'Assembly', '.s': 'Assembly', '.tex': 'TeX',
+}
+FILENAME_LANGUAGES = {
+    'makefile': 'Makefile', 'gnumakefile': 'Makefile', 'dockerfile': 'Dockerfile',
+    'cmakelists.txt': 'CMake', 'rakefile': 'Ruby', 'gemfile': 'Ruby',
+}
+SHEBANG_LANGUAGES = {
+    'python': 'Python', 'python2': 'Python', 'python3': 'Python',
+    'node': 'JavaScript', 'nodejs': 'JavaScript', 'deno': 'TypeScript',
+    'sh': 'Shell', 'bash': 'Shell', 'zsh': 'Shell', 'dash': 'Shell', 'ksh': 'Shell',
+    'ruby': 'Ruby', 'perl': 'Perl', 'php': 'PHP', 'lua': 'Lua', 'Rscript': 'R',
+}
+
+def shebang_language(path):
+    # Читаем только начало файла
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(128)
+    except OSError:
+        return None
+    if not head.startswith(b'#!'):
+        return None
+    parts = head[2:].split(b'\n', 1)[0].decode('utf-8', 'replace').split()
+    if not parts:
+        return None
+    interpreter = os.path.basename(parts[0])
+    if interpreter == 'env' and len(parts) > 1:
+        interpreter = parts[1] if not parts[1].startswith('-') else parts[-1]
+    return SHEBANG_LANGUAGES.get(interpreter.rstrip('0123456789.') or interpreter,
+                                 SHEBANG_LANGUAGES.get(interpreter))
+
+def detect_file_language(filename, path):
+    name = filename.lower()
+    if name in FILENAME_LANGUAGES:
+        return FILENAME_LANGUAGES[name]
+    ext = os.path.splitext(name)[1]
+    if ext in EXTENSION_LANGUAGES:
+        return EXTENSION_LANGUAGES[ext]
+    if not ext:
+        return shebang_language(path) or ''
+    return ''
+
+def language_breakdown(totals):
+    # Проценты методом наибольших остатков, чтобы сумма была ровно 100; языки меньше 1% отбрасываются
+    total = sum(totals.values())
+    if not total:
+        return []
+    shares = {name: size * 100 / total for name, size in totals.items()}
+    percents = {name: int(share) for name, share in shares.items()}
+    rest = 100 - sum(percents.values())
+    for name in sorted(shares, key=lambda n: shares[n] - percents[n], reverse=True)[:rest]:
+        percents[name] += 1
+    pairs = sorted(((name, perc) for name, perc in percents.items() if perc >= 1),
+                   key=lambda pair: (-pair[1], pair[0]))
+    return pairs
+
+# Потоковая загрузка файлов: части multipart пишутся во временный файл блоками
+# и хешируются на лету, поэтому память не растёт с размером загрузки
+class HashingTempFile:
+    def __init__(self, directory):
+        self.file = tempfile.NamedTemporaryFile(
+            dir=directory, prefix='upload-', delete=False,
+            buffering=app.config['UPLOAD_CHUNK_SIZE'],
+        )
+        self.name = self.file.name
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    @property
+    def sha256(self):
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+def upload_tmp_dir():
+    # Временные файлы лежат внутри UPLOAD_FOLDER, чтобы os.replace был атомарным
+    path = os.path.join(app.config['UPLOAD_FOLDER'], '.tmp')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+class StreamingUploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = HashingTempFile(upload_tmp_dir())
+        self.upload_tempfiles.append(stream)
+        return stream
+
+    @property
+    def upload_tempfiles(self):
+        return self.environ.setdefault('entard.upload_tempfiles', [])
+
+app.request_class = StreamingUploadRequest
+
+@app.teardown_request
+def cleanup_upload_tempfiles(exc):
+    # Удаляем временные файлы, которые не были перенесены в хранилище
+    for stream in request.environ.pop('entard.upload_tempfiles', []):
+        stream.file.close()
+        try:
+            os.unlink(stream.name)
+        except FileNotFoundError:
+            pass
+
+def spool_upload(file):
+    stream = file.stream
+    if not isinstance(stream, HashingTempFile):
+        stream = HashingTempFile(upload_tmp_dir())
+        request.upload_tempfiles.append(stream)
+        chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+        for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+            stream.write(chunk)
+    stream.file.flush()
+    os.fsync(stream.file.fileno())
+    stream.file.close()
+    return stream
+
+# Хранилище блобов: файл с хешем abcdef... лежит в blobs/ab/cd/abcdef...
+def blob_relpath(sha256):
+    return os.path.join('blobs', sha256[:2], sha256[2:4], sha256)
+
+def store_blob(tmp_path, sha256):
+    # Переносит временный файл в хранилище; если такой блоб уже есть, просто удаляет копию
+    relpath = blob_relpath(sha256)
+    dest = os.path.join(app.config['UPLOAD_FOLDER'], relpath)
+    try:
+        # Обновляем mtime, чтобы сборщик мусора не удалил блоб, пока строка не закоммичена
+        os.utime(dest)
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        # Блоба нет (или gc-blobs как раз его убрал) - кладём свою копию
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(tmp_path, dest)
+    return relpath
+
+def link_blob(path, sha256):
+    # Как store_blob, но оригинал остаётся на месте: жёсткая ссылка или копия
+    relpath = blob_relpath(sha256)
+    dest = os.path.join(app.config['UPLOAD_FOLDER'], relpath)
+    if not os.path.exists(dest):
+        tmp = os.path.join(upload_tmp_dir(), f'link-{uuid.uuid4().hex}')
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(tmp, dest)
+    # Жёсткая ссылка сохраняет старый mtime; обновляем, чтобы gc-blobs не удалил блоб до коммита
+    os.utime(dest)
+    return relpath
+
+def add_blob_refs(blobs):
+    # blobs - словарь sha256 -> (size, число новых ссылок)
+    if not blobs:
+        return
+    db.session.execute(
+        insert_ignore(Blob.__table__),
+        [{'sha256': sha256, 'size': size, 'refcount': 0, 'created_at': datetime.utcnow()}
+         for sha256, (size, _) in blobs.items()],
+    )
+    db.session.execute(
+        db.text('UPDATE blob SET refcount = refcount + :n WHERE sha256 = :sha256'),
+        [{'sha256': sha256, 'n': n} for sha256, (_, n) in blobs.items()],
+    )
+
+def save_uploaded_files(project, files):
+    # Переносит загруженные файлы в хранилище блобов и вставляет строки ProjectFile пачкой
+    now = datetime.utcnow()
+    rows = []
+    blobs = {}
+    for file in files:
+        if not file or not file.filename:
+            continue
+        filename = secure_filename(file.filename)
+        if not filename:
+            continue
+        stream = spool_upload(file)
+        sha256 = stream.sha256
+        rows.append({
+            'filename': filename,
+            'filepath': store_blob(stream.name, sha256),
+            'upload_date': now,
+            'size': stream.size,
+            'sha256': sha256,
+            'blob_sha256': sha256,
+            'project_id': project.id,
+        })
+        blobs[sha256] = (stream.size, blobs.get(sha256, (0, 0))[1] + 1)
+    if rows:
+        add_blob_refs(blobs)
+        db.session.execute(db.insert(ProjectFile), rows)
+    return rows
+
+# Фоновые задачи
+JOB_HANDLERS = {}
+JOB_LABELS = {}
+JOB_FAILURE_HANDLERS = {}
+
+def job_handler(kind, label, on_failure=None):
+    # on_failure(error, **payload) вызывается, когда задача окончательно помечена failed
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        JOB_LABELS[kind] = label
+        if on_failure is not None:
+            JOB_FAILURE_HANDLERS[kind] = on_failure
+        return func
+    return decorator
+
+def job_failed(kind, payload, error):
+    handler = JOB_FAILURE_HANDLERS.get(kind)
+    if handler is None:
+        return
+    try:
+        handler(error, **json.loads(payload))
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('Не удалось обработать отказ задачи %s', kind)
+
+def enqueue_job(kind, project_id=None, **payload):
+    # Задача попадает в БД вместе с текущей транзакцией; обработчики будятся после коммита
+    if project_id is not None:
+        payload['project_id'] = project_id
+    job = Job(kind=kind, payload=json.dumps(payload), project_id=project_id,
+              max_attempts=app.config['JOB_MAX_ATTEMPTS'])
+    db.session.add(job)
+    if has_request_context():
+        g.setdefault('enqueued_jobs', []).append(job)
+    return job
+
+def retry_delay(attempts):
+    # Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли пачкой
+    delay = min(app.config['JOB_RETRY_DELAY'] * 2 ** (attempts - 1), app.config['JOB_RETRY_MAX_DELAY'])
+    return delay * random.uniform(0.8, 1.2)
+
+class JobRunner:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.pid = None
+        self.last_reclaim = 0
+        self.last_decay = 0
+
+    def ensure_started(self, count=None):
+        count = app.config['JOB_INLINE_WORKERS'] if count is None else count
+        if count <= 0 or (self.pid == os.getpid() and self.threads):
+            return
+        with self.lock:
+            # Потоки не переживают fork, поэтому в каждом воркере запускаем свои
+            if self.pid == os.getpid() and self.threads:
+                return
+            self.pid = os.getpid()
+            self.stopping.clear()
+            self.threads = [
+                threading.Thread(target=self.run, name=f'job-worker-{i}', daemon=True)
+                for i in range(count)
+            ]
+            for thread in self.threads:
+                thread.start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                with app.app_context():
+                    worked = self.run_one()
+            except Exception:
+                app.logger.exception('Ошибка обработчика фоновых задач')
+                worked = False
+            if not worked:
+                self.wakeup.wait(app.config['JOB_POLL_INTERVAL'])
+                self.wakeup.clear()
+
+    def reclaim_stale(self):
+        # Задачи в running без отметки обработчика дольше JOB_TIMEOUT - воркер упал. Попытка
+        # уже засчитана при захвате; задача, исчерпавшая попытки (например, каждый раз
+        # роняющая воркер), помечается failed, остальные возвращаются в очередь с задержкой
+        cutoff = datetime.utcfromtimestamp(time.time() - app.config['JOB_TIMEOUT'])
+        now = datetime.utcnow()
+        stale = and_(Job.status == 'running', Job.updated_at < cutoff)
+        error = 'Обработчик перестал отвечать'
+        with db.engine.begin() as conn:
+            exhausted = conn.execute(
+                db.select(Job.id, Job.kind, Job.payload).where(stale, Job.attempts >= Job.max_attempts)
+            ).all()
+            failed = [job for job in exhausted if conn.execute(
+                db.update(Job).where(Job.id == job.id, stale)
+                .values(status='failed', last_error=error, updated_at=now)
+            ).rowcount]
+            conn.execute(
+                db.update(Job).where(stale).values(
+                    status='queued', last_error=error, updated_at=now,
+                    run_after=datetime.utcfromtimestamp(time.time() + app.config['JOB_RETRY_DELAY']),
+                )
+            )
+        for job in failed:
+            job_failed(job.kind, job.payload, error)
+
+    def heartbeat(self, job_id, done):
+        # Пока задача выполняется, обновляем updated_at, чтобы reclaim_stale её не забрал
+        while not done.wait(app.config['JOB_HEARTBEAT_INTERVAL']):
+            try:
+                with app.app_context(), db.engine.begin() as conn:
+                    alive = conn.execute(
+                        db.update(Job).where(Job.id == job_id, Job.status == 'running')
+                        .values(updated_at=datetime.utcnow())
+                    ).rowcount
+            except Exception:
+                app.logger.exception('Не удалось отметить задачу %s', job_id)
+                continue
+            if not alive:
+                app.logger.warning('Задача %s больше не числится за этим обработчиком', job_id)
+                return
+
+    def claim(self):
+        now = time.time()
+        if now - self.last_reclaim > app.config['JOB_TIMEOUT'] / 10:
+            self.last_reclaim = now
+            self.reclaim_stale()
+        if now - self.last_decay > app.config['TRENDING_DECAY_INTERVAL'] / 10:
+            self.last_decay = now
+            with db.engine.begin() as conn:
+                decayed = decay_trending(conn)
+            if decayed:
+                page_cache.invalidate('trending')
+        # Сначала только чтение: пустая очередь не берёт блокировку записи
+        with db.engine.connect() as conn:
+            job_id = conn.execute(
+                db.select(Job.id).where(Job.status == 'queued', Job.run_after <= datetime.utcnow())
+                .order_by(Job.run_after, Job.id).limit(1)
+            ).scalar()
+        if job_id is None:
+            return None
+        with db.engine.begin() as conn:
+            # Условие на статус: задачу забирает только один обработчик
+            claimed = conn.execute(
+                db.update(Job).where(Job.id == job_id, Job.status == 'queued')
+                .values(status='running', attempts=Job.attempts + 1, updated_at=datetime.utcnow())
+            ).rowcount
+        if not claimed:
+            return None
+        return db.session.get(Job, job_id)
+
+    def finish(self, job, status, error=None, run_after=None):
+        job.status = status
+        job.last_error = error
+        job.updated_at = datetime.utcnow()
+        if run_after is not None:
+            job.run_after = run_after
+        db.session.commit()
+        if job.project_id:
+            page_cache.invalidate(f'project:{job.project_id}')
+
+    def run_one(self):
+        job = self.claim()
+        if job is None:
+            return False
+        if job.project_id:
+            page_cache.invalidate(f'project:{job.project_id}')
+        handler = JOB_HANDLERS.get(job.kind)
+        done = threading.Event()
+        threading.Thread(target=self.heartbeat, args=(job.id, done),
+                         name=f'job-heartbeat-{job.id}', daemon=True).start()
+        try:
+            if handler is None:
+                raise LookupError(f'Неизвестный тип задачи: {job.kind}')
+            handler(**json.loads(job.payload))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('Задача %s (%s) завершилась ошибкой', job.id, job.kind)
+            error = f'{type(e).__name__}: {e}'
+            if job.attempts < job.max_attempts:
+                delay = retry_delay(job.attempts)
+                self.finish(job, 'queued', error, datetime.utcfromtimestamp(time.time() + delay))
+            else:
+                self.finish(job, 'failed', error)
+                job_failed(job.kind, job.payload, error)
+            return True
+        finally:
+            done.set()
+        self.finish(job, 'done')
+        return True
+
+job_runner = JobRunner()
+
+@app.before_request
+def start_job_workers():
+    job_runner.ensure_started()
+
+@app.after_request
+def wake_job_workers(response):
+    if g.get('enqueued_jobs'):
+        job_runner.wake()
+    return response
+
+# Кэш пользователей: на время запроса в g и в LRU процесса с TTL. Хранятся только открытые
+# поля, без хеша пароля. Изменение строки пользователя сбрасывает запись в этом процессе,
+# остальные воркеры увидят его не позже чем через USER_CACHE_TTL
+UserInfo = collections.namedtuple('UserInfo', 'id username email created_at')
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'])
+
+def get_user(user_id):
+    if user_id is None:
+        return None
+    users = g.setdefault('users', {})
+    if user_id in users:
+        return users[user_id]
+    entry = user_cache.get(user_id)
+    if entry is not None and entry[1] > time.monotonic():
+        user = entry[0]
+    else:
+        row = db.session.execute(
+            db.select(User.id, User.username, User.email, User.created_at).where(User.id == user_id)
+        ).first()
+        user = UserInfo(*row) if row else None
+        if user is not None:
+            user_cache.set(user_id, (user, time.monotonic() + app.config['USER_CACHE_TTL']))
+    users[user_id] = user
+    return user
+
+def current_user():
+    return get_user(session.get('user_id'))
+
+def invalidate_user(user_id):
+    user_cache.pop(user_id)
+    if has_request_context():
+        g.get('users', {}).pop(user_id, None)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_cached_user(mapper, connection, target):
+    invalidate_user(target.id)
+
+# HTML шаблон: компилируется один раз при импорте, на запрос остаётся только подстановка
+BASE_TEMPLATE = app.jinja_env.from_string('''
     <!DOCTYPE html>
     <html lang="ru">
     <head>
         <meta charset="UTF-8">
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{title} - Entard</title>
-        <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet">
-        <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.1/font/bootstrap-icons.css">
-        <style>
-            body {{ background-color: #0d1117; color: #c9d1d9; }}
-            .navbar {{ background-color: #161b22; border-bottom: 1px solid #30363d; }}
-            .card {{ background-color: #161b22; border: 1px solid #30363d; }}
-            .btn-primary {{ background-color: #238636; border-color: #238636; }}
-            .btn-primary:hover {{ background-color: #2ea043; }}
-            .language-bar {{ height: 8px; background: #30363d; border-radius: 4px; overflow: hidden; margin: 5px 0; }}
-            .language-fill {{ height: 100%; float: left; }}
-            .file-list {{ max-height: 300px; overflow-y: auto; }}
-            .file-item {{ padding: 8px; border-bottom: 1px solid #30363d; }}
-            .file-item:hover {{ background-color: #21262d; }}
-        </style>
+        <title>{{ title }} - Entard</title>
+        <link href="{{ static_url('vendor/bootstrap.min.css') }}" rel="stylesheet">
+        <link rel="stylesheet" href="{{ static_url('vendor/bootstrap-icons.css') }}">
+        <link rel="stylesheet" href="{{ static_url('entard.css') }}">
     </head>
     <body>
         <nav class="navbar navbar-expand-lg navbar-dark">
@@ -97,100 +1630,463 @@ def render_page(title, content):
                 <a class="navbar-brand" href="/">
                     <i class="bi bi-code-slash"></i> Entard
                 </a>
+                <form class="d-flex me-auto ms-3" action="/search" method="GET">
+                    <input type="search" name="q" class="form-control form-control-sm" placeholder="Поиск проектов">
+                </form>
                 <div class="d-flex">
-                    {auth_buttons}
+                    <a href="/trending" class="btn btn-outline-light me-2">
+                        <i class="bi bi-fire"></i> В тренде
+                    </a>
+                    {% if username %}
+                    <a href="/create" class="btn btn-primary me-2">
+                        <i class="bi bi-plus-lg"></i> Новый проект
+                    </a>
+                    <a href="/profile" class="btn btn-outline-light me-2">
+                        <i class="bi bi-person-circle"></i> {{ username }}
+                    </a>
+                    <a href="/logout" class="btn btn-outline-danger">Выйти</a>
+                    {% else %}
+                    <a href="/login" class="btn btn-outline-light me-2">Войти</a>
+                    <a href="/register" class="btn btn-primary">Регистрация</a>
+                    {% endif %}
                 </div>
             </div>
         </nav>
         
         <div class="container mt-4">
-            {content}
+            {{ content }}
         </div>
         
-        <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/js/bootstrap.bundle.min.js"></script>
+        <script src="{{ static_url('vendor/popper.min.js') }}"></script>
+        <script src="{{ static_url('vendor/bootstrap.min.js') }}"></script>
     </body>
     </html>
-    '''
-    return base_html
+''')
 
-# Главная страница
-@app.route('/')
-def index():
-    projects = Project.query.order_by(Project.created_at.desc()).all()
-    
-    # Создаем HTML для проектов
-    projects_html = ""
-    for project in projects:
-        langs_html = ""
-        if project.languages:
-            langs = project.languages.split(',')
-            langs_html = '<div class="language-bar">'
-            for lang in langs:
-                if ':' in lang:
-                    name, perc = lang.split(':')
-                    color = f"hsl({hash(name) % 360}, 70%, 50%)"
-                    langs_html += f'<div class="language-fill" style="width: {perc}%; background-color: {color};" title="{name}: {perc}%"></div>'
-            langs_html += '</div>'
-        
-        projects_html += f'''
-        <div class="col-md-4 mb-4">
-            <div class="card h-100">
-                <div class="card-body">
-                    <h5 class="card-title">{project.title}</h5>
-                    <p class="card-text text-muted">
-                        {project.description[:100]}{"..." if len(project.description) > 100 else ""}
-                    </p>
-                    {langs_html}
-                    <div class="d-flex justify-content-between align-items-center mt-3">
-                        <small class="text-muted">
-                            <i class="bi bi-person"></i> {project.author.username}
-                        </small>
-                        <small class="text-muted">
-                            <i class="bi bi-star"></i> {project.stars}
-                            <i class="bi bi-folder me-2 ms-2"></i> {len(project.files)}
-                        </small>
-                    </div>
-                    <a href="/project/{project.id}" class="btn btn-sm btn-primary mt-2 w-100">Подробнее</a>
+def render_page(title, content):
+    # content - уже готовый HTML (Markup или строка из шаблона)
+    user = current_user()
+    return BASE_TEMPLATE.render(
+        title=title,
+        content=Markup(content),
+        username=user.username if user else None,
+    )
+
+# Кэш страниц. Запись помнит версии своих тегов ('feed', 'project:5', 'user:3') на момент
+# рендеринга; запись на сайте увеличивает версии затронутых тегов, и старые записи перестают
+# совпадать. Версии тегов и сами страницы лежат в общем файле SQLite, поэтому инвалидация
+# в одном процессе сразу видна всем воркерам.
+class SQLitePageStore:
+    def __init__(self, path, maxsize):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.maxsize = maxsize
+        self.local = threading.local()
+        self.writes = 0
+        with self.connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS page_cache '
+                         '(key TEXT PRIMARY KEY, body BLOB, versions TEXT, created REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_page_cache_created ON page_cache (created)')
+            conn.execute('CREATE TABLE IF NOT EXISTS page_cache_tags (tag TEXT PRIMARY KEY, version INTEGER)')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def tag_versions(self, tags):
+        placeholders = ','.join('?' * len(tags))
+        rows = self.connection().execute(
+            f'SELECT tag, version FROM page_cache_tags WHERE tag IN ({placeholders})', tags).fetchall()
+        versions = dict.fromkeys(tags, 0)
+        versions.update(rows)
+        return versions
+
+    def bump(self, tags):
+        self.connection().executemany(
+            'INSERT INTO page_cache_tags (tag, version) VALUES (?, 1) '
+            'ON CONFLICT(tag) DO UPDATE SET version = version + 1', [(tag,) for tag in tags])
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT body, versions, created FROM page_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def set(self, key, body, versions, created):
+        conn = self.connection()
+        conn.execute('INSERT OR REPLACE INTO page_cache (key, body, versions, created) VALUES (?, ?, ?, ?)',
+                     (key, body, json.dumps(versions), created))
+        self.writes += 1
+        if self.writes % 100 == 0:
+            conn.execute('DELETE FROM page_cache WHERE key IN (SELECT key FROM page_cache '
+                         'ORDER BY created DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+class PageCache:
+    # open_shared возвращает общее хранилище или None; файл открывается при первом обращении,
+    # чтобы import entard (flask --help, бенчмарки) ничего не создавал на диске
+    def __init__(self, maxsize, ttl, open_shared=None):
+        self.memory = LRUCache(maxsize)
+        self.ttl = ttl
+        self.open_shared = open_shared
+        self.shared_store = None
+        self.shared_opened = open_shared is None
+        self.versions = collections.Counter()
+        self.lock = threading.Lock()
+        self.refreshing = set()
+
+    @property
+    def shared(self):
+        if not self.shared_opened:
+            with self.lock:
+                if not self.shared_opened:
+                    self.shared_store = self.open_shared()
+                    self.shared_opened = True
+        return self.shared_store
+
+    def tag_versions(self, tags):
+        if self.shared is not None:
+            return self.shared.tag_versions(tags)
+        with self.lock:
+            return {tag: self.versions[tag] for tag in tags}
+
+    def invalidate(self, *tags):
+        if self.shared is not None:
+            self.shared.bump(tags)
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] += 1
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        return entry
+
+    def set(self, key, body, versions):
+        entry = (body, versions, time.time())
+        self.memory.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, *entry)
+
+    def is_fresh(self, entry, current):
+        body, versions, created = entry
+        return versions == current and time.time() - created < self.ttl
+
+def page_cache_shared_path():
+    path = app.config['PAGE_CACHE_SHARED_PATH']
+    if path is None:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], '.page_cache.sqlite')
+    return path
+
+def open_shared_page_store():
+    path = page_cache_shared_path()
+    return SQLitePageStore(path, app.config['PAGE_CACHE_SHARED_SIZE']) if path else None
+
+page_cache = PageCache(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'], open_shared_page_store)
+
+def page_cache_key():
+    # Навигация показывает имя пользователя, поэтому страницы кэшируются отдельно для каждого
+    viewer = f"user:{session['user_id']}" if 'user_id' in session else 'anon'
+    query = '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+    return f'{request.path}?{query}|{viewer}'
+
+def refresh_page_in_background(key, view, kwargs, tags):
+    # Перестраивает анонимную страницу в фоне; пока идёт рендеринг, отдаётся старая версия
+    with page_cache.lock:
+        if key in page_cache.refreshing:
+            return
+        page_cache.refreshing.add(key)
+    path, query_string = request.path, request.query_string
+
+    def refresh():
+        try:
+            with app.test_request_context(path, query_string=query_string):
+                versions = page_cache.tag_versions(tags)
+                response = app.make_response(view(**kwargs))
+                if response.status_code == 200:
+                    page_cache.set(key, response.get_data(), versions)
+        except Exception:
+            app.logger.exception('Не удалось обновить страницу %s в кэше', path)
+        finally:
+            with page_cache.lock:
+                page_cache.refreshing.discard(key)
+
+    threading.Thread(target=refresh, name='page-cache-refresh', daemon=True).start()
+
+def cached_page(tags, stale_seconds=0):
+    # tags - функция от аргументов маршрута, возвращающая список тегов страницы
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if not app.config['PAGE_CACHE_ENABLED'] or request.method != 'GET':
+                return view(**kwargs)
+            key = page_cache_key()
+            page_tags = tags(**kwargs)
+            current = page_cache.tag_versions(page_tags)
+            entry = page_cache.get(key)
+            if entry is not None:
+                if page_cache.is_fresh(entry, current):
+                    return Response(entry[0], mimetype='text/html', headers={'X-Cache': 'HIT'})
+                # Устаревшей по времени странице можно побыть ещё stale_seconds, пока строится новая;
+                # инвалидированная записью (версии тегов сменились) отдаётся только свежей
+                stale_limit = page_cache.ttl + stale_seconds
+                if (stale_seconds and key.endswith('|anon') and entry[1] == current
+                        and time.time() - entry[2] < stale_limit):
+                    refresh_page_in_background(key, view, kwargs, page_tags)
+                    return Response(entry[0], mimetype='text/html', headers={'X-Cache': 'STALE'})
+            response = app.make_response(view(**kwargs))
+            if response.status_code == 200 and response.mimetype == 'text/html':
+                page_cache.set(key, response.get_data(), current)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+# Курсор ленты: пара (created_at, id) последней карточки на странице
+def encode_feed_cursor(project):
+    return f"{project.created_at.isoformat()}_{project.id}"
+
+def decode_feed_cursor(cursor):
+    try:
+        created_at, project_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(project_id)
+    except ValueError:
+        abort(400)
+
+# Число файлов проекта коррелированным подзапросом вместо ленивой загрузки project.files
+def file_count_subquery():
+    return (
+        db.select(db.func.count(ProjectFile.id))
+        .where(ProjectFile.project_id == Project.id)
+        .scalar_subquery()
+    )
+
+# Одна страница ленты: авторы подгружаются join'ом, число файлов - подзапросом
+def feed_page(cursor=None, page_size=None):
+    page_size = page_size or app.config['FEED_PAGE_SIZE']
+    query = (
+        db.select(Project, file_count_subquery())
+        .options(joinedload(Project.author), selectinload(Project.language_stats))
+        .order_by(Project.created_at.desc(), Project.id.desc())
+        .limit(page_size + 1)
+    )
+    if cursor:
+        created_at, project_id = decode_feed_cursor(cursor)
+        query = query.where(or_(
+            Project.created_at < created_at,
+            and_(Project.created_at == created_at, Project.id < project_id),
+        ))
+    rows = db.session.execute(query).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_feed_cursor(rows[-1][0])
+    return rows, next_cursor
+
+# Карточки проектов, общие для ленты, поиска и трендов. Цикл вставляется в текст каждого
+# шаблона и компилируется вместе с ним: вызов макроса на каждую карточку заметно дороже
+PROJECT_CARDS = '''
+    {% for project, files_count in rows %}
+    <div class="col-md-4 mb-4">
+        <div class="card h-100">
+            <div class="card-body">
+                <h5 class="card-title">{{ project.title }}</h5>
+                <p class="card-text text-muted">
+                    {{ project.description[:100] }}{% if project.description|length > 100 %}...{% endif %}
+                </p>
+                {% if project.language_stats %}
+                <div class="language-bar">
+                    {% for lang in project.language_stats %}
+                    <div class="language-fill" style="width: {{ lang.percent }}%; background-color: {{ lang.color }};" title="{{ lang.name }}: {{ lang.percent }}%"></div>
+                    {% endfor %}
                 </div>
+                {% endif %}
+                <div class="d-flex justify-content-between align-items-center mt-3">
+                    <small class="text-muted">
+                        <i class="bi bi-person"></i> {{ project.author.username }}
+                    </small>
+                    <small class="text-muted">
+                        <i class="bi bi-star"></i> {{ project.stars }}
+                        <i class="bi bi-folder me-2 ms-2"></i> {{ files_count }}
+                    </small>
+                </div>
+                <a href="/project/{{ project.id }}" class="btn btn-sm btn-primary mt-2 w-100">Подробнее</a>
             </div>
         </div>
-        '''
-    
-    content = f'''
+    </div>
+    {% endfor %}
+'''
+
+FEED_TEMPLATE = app.jinja_env.from_string('''
     <h1><i class="bi bi-code-slash"></i> Entard</h1>
     <p class="text-muted">Площадка для проектов с загрузкой файлов</p>
     
     <div class="row mt-4">
-        {projects_html}
+''' + PROJECT_CARDS + '''
     </div>
-    '''
     
+    <div class="d-flex justify-content-center mb-4">
+        {% if cursor %}<a href="/" class="btn btn-outline-light me-2">В начало</a>{% endif %}
+        {% if next_cursor %}<a href="/?before={{ next_cursor|urlencode }}" class="btn btn-outline-light">Следующая страница</a>{% endif %}
+    </div>
+''')
+
+# Главная страница
+@app.route('/')
+@cached_page(lambda: ['feed'], stale_seconds=app.config['FEED_STALE_SECONDS'])
+@read_only_route
+def index():
+    cursor = request.args.get('before')
+    rows, next_cursor = feed_page(cursor)
+    content = FEED_TEMPLATE.render(rows=rows, cursor=cursor, next_cursor=next_cursor)
     return render_page("Главная", content)
 
-# Регистрация
-@app.route('/register', methods=['GET', 'POST'])
-def register():
-    if request.method == 'POST':
-        username = request.form['username']
-        email = request.form['email']
-        password = request.form['password']
-        
-        if User.query.filter_by(username=username).first():
-            flash('Имя пользователя уже занято')
-            return redirect('/register')
-        
-        hashed_password = generate_password_hash(password)
-        user = User(username=username, email=email, password_hash=hashed_password)
-        
-        db.session.add(user)
-        db.session.commit()
-        
-        session['user_id'] = user.id
-        session['username'] = user.username
-        flash('Регистрация успешна!')
-        return redirect('/')
-    
-    content = '''
+# Пароли: алгоритм и стоимость задаются PASSWORD_HASH_METHOD, старые хеши пересчитываются
+# при успешном входе. Хеширование идёт в отдельном небольшом пуле потоков: scrypt и pbkdf2
+# отпускают GIL, поэтому проверки паролей занимают не больше PASSWORD_HASH_WORKERS ядер
+# (и памяти scrypt) и не отнимают потоки у страниц. Очередь пула ограничена, при наплыве
+# входов лишние запросы сразу получают 503.
+class PasswordHasher:
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+
+    def executor(self):
+        # Потоки пула не переживают fork, поэтому в каждом воркере свой пул
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hash')
+                    self.pid = os.getpid()
+        return self.pool
+
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            raise ServiceUnavailable('Сервер перегружен, попробуйте ещё раз', retry_after=1)
+        try:
+            return self.executor().submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_HASH_QUEUE'])
+
+@functools.lru_cache(maxsize=None)
+def hash_method_prefix(method):
+    # 'scrypt' -> 'scrypt:32768:8:1': так метод записан в начале готового хеша
+    return generate_password_hash('', method).split('$', 1)[0]
+
+def hash_password(password):
+    return password_hasher.run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password):
+    return password_hasher.run(check_password_hash, password_hash, password)
+
+def password_needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != hash_method_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+# Ограничение частоты входов и регистраций: token bucket на IP и на имя пользователя.
+# Корзины хранятся в памяти процесса или, если задан RATE_LIMIT_SHARED_PATH, в файле SQLite,
+# общем для всех воркеров. Лимит записывается как "попыток/секунд": "10/60".
+def parse_rate(text):
+    if not text or text == '0':
+        return None
+    count, seconds = text.split('/')
+    return int(count), float(seconds)
+
+def take_token(tokens, updated, now, capacity, rate):
+    # Возвращает остаток токенов и сколько секунд ждать, если токена нет
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+class MemoryBucketStore:
+    def __init__(self, maxsize):
+        self.buckets = LRUCache(maxsize)
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.time()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens, wait = take_token(tokens, updated, now, capacity, rate)
+            self.buckets.set(key, (tokens, now))
+        return wait
+
+class SQLiteBucketStore:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        self.connection().execute('CREATE TABLE IF NOT EXISTS rate_limit '
+                                  '(key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL)')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, capacity, rate):
+        conn = self.connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM rate_limit WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens, wait = take_token(tokens, updated, now, capacity, rate)
+            conn.execute('INSERT OR REPLACE INTO rate_limit (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                         (key, tokens, now, now + (capacity - tokens) / rate))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            # Полная корзина ничем не отличается от отсутствующей
+            conn.execute('DELETE FROM rate_limit WHERE full_at < ?', (now,))
+        return wait
+
+rate_limit_store = (SQLiteBucketStore(app.config['RATE_LIMIT_SHARED_PATH'])
+                    if app.config['RATE_LIMIT_SHARED_PATH'] else MemoryBucketStore(100000))
+
+def rate_limited(*limits):
+    # limits - пары (ключ корзины, имя настройки с лимитом); возвращает секунды до
+    # следующей попытки или 0. При сбое хранилища запрос пропускается
+    wait = 0
+    for key, setting in limits:
+        rate = parse_rate(app.config[setting])
+        if rate is None:
+            continue
+        capacity, seconds = rate
+        try:
+            wait = max(wait, rate_limit_store.take(key, capacity, capacity / seconds))
+        except Exception:
+            app.logger.exception('Ошибка ограничителя частоты запросов')
+    return wait
+
+def too_many_attempts(title, form, wait):
+    seconds = int(wait) + 1
+    alert = Markup('<div class="alert alert-warning text-center">Слишком много попыток, '
+                   'повторите через %d с</div>') % seconds
+    return render_page(title, alert + form), 429, {'Retry-After': str(seconds)}
+
+# Статичные формы собираются один раз при импорте
+REGISTER_FORM = Markup('''
     <div class="row justify-content-center">
         <div class="col-md-6">
             <div class="card">
@@ -220,28 +2116,127 @@ def register():
             </div>
         </div>
     </div>
-    '''
+''')
+
+SEARCH_TEMPLATE = app.jinja_env.from_string('''
+    <h2><i class="bi bi-search"></i> Поиск проектов</h2>
+    <form class="row g-2 mt-2" action="/search" method="GET">
+        <div class="col-md-7">
+            <input type="search" name="q" value="{{ q }}" class="form-control" placeholder="Название или описание">
+        </div>
+        <div class="col-md-3">
+            <select name="lang" class="form-select">
+                <option value="">Любой язык</option>
+                {% for name in languages %}
+                <option value="{{ name }}"{% if name == lang %} selected{% endif %}>{{ name }}</option>
+                {% endfor %}
+            </select>
+        </div>
+        <div class="col-md-2">
+            <button type="submit" class="btn btn-primary w-100">Найти</button>
+        </div>
+    </form>
+    
+    <div class="row mt-4">
+''' + PROJECT_CARDS + '''
+        {% if not rows and (q or lang) %}<p class="text-muted">Ничего не найдено</p>{% endif %}
+    </div>
     
-    return render_page("Регистрация", content)
+    <div class="d-flex justify-content-center mb-4">
+        {% if page > 1 %}<a href="/search?{{ {'q': q, 'lang': lang, 'page': page - 1}|urlencode }}" class="btn btn-outline-light me-2">Назад</a>{% endif %}
+        {% if has_next %}<a href="/search?{{ {'q': q, 'lang': lang, 'page': page + 1}|urlencode }}" class="btn btn-outline-light">Дальше</a>{% endif %}
+    </div>
+''')
 
-# Вход
-@app.route('/login', methods=['GET', 'POST'])
-def login():
+# Запрос FTS5 из пользовательского ввода: каждое слово ищется по префиксу
+def fts_query(text):
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"*' for term in terms if term)
+
+def search_projects(q, lang, page, page_size):
+    # Возвращает страницу (Project, число файлов) в порядке релевантности и признак следующей страницы
+    offset = (page - 1) * page_size
+    query = db.select(Project.id)
+    if q and search_index_enabled():
+        # bm25: меньше - релевантнее; совпадение в названии весит больше, чем в описании
+        matches = (db.text("SELECT rowid, bm25(project_fts, 10.0, 1.0) AS rank "
+                           "FROM project_fts WHERE project_fts MATCH :match")
+                   .bindparams(match=fts_query(q))
+                   .columns(rowid=db.Integer, rank=db.Float)
+                   .subquery('matches'))
+        query = (query.join(matches, matches.c.rowid == Project.id)
+                 .order_by(matches.c.rank, Project.id.desc()))
+    else:
+        if q:
+            pattern = f'%{q}%'
+            query = query.where(or_(Project.title.ilike(pattern), Project.description.ilike(pattern)))
+        query = query.order_by(Project.created_at.desc(), Project.id.desc())
+    if lang:
+        query = query.where(Project.id.in_(
+            db.select(ProjectLanguage.project_id).where(ProjectLanguage.name == lang)))
+    ids = db.session.execute(query.limit(page_size + 1).offset(offset)).scalars().all()
+    has_next = len(ids) > page_size
+    ids = ids[:page_size]
+    if not ids:
+        return [], has_next
+    rows = db.session.execute(
+        db.select(Project, file_count_subquery())
+        .where(Project.id.in_(ids))
+        .options(joinedload(Project.author), selectinload(Project.language_stats))
+    ).all()
+    order = {project_id: position for position, project_id in enumerate(ids)}
+    rows.sort(key=lambda row: order[row[0].id])
+    return rows, has_next
+
+# Поиск
+@app.route('/search')
+@read_only_route
+def search():
+    q = request.args.get('q', '').strip()
+    lang = request.args.get('lang', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    rows, has_next = [], False
+    if q or lang:
+        rows, has_next = search_projects(q, lang, page, app.config['FEED_PAGE_SIZE'])
+    languages = db.session.execute(
+        db.select(ProjectLanguage.name).distinct().order_by(ProjectLanguage.name)
+    ).scalars().all()
+    content = SEARCH_TEMPLATE.render(q=q, lang=lang, page=page, has_next=has_next,
+                                     rows=rows, languages=languages)
+    return render_page("Поиск", content)
+
+# Регистрация
+@app.route('/register', methods=['GET', 'POST'])
+def register():
     if request.method == 'POST':
         username = request.form['username']
+        email = request.form['email']
         password = request.form['password']
         
-        user = User.query.filter_by(username=username).first()
+        wait = rate_limited((f'register-ip:{request.remote_addr}', 'REGISTER_RATE_LIMIT_IP'))
+        if wait:
+            return too_many_attempts("Регистрация", REGISTER_FORM, wait)
         
-        if user and check_password_hash(user.password_hash, password):
-            session['user_id'] = user.id
-            session['username'] = user.username
-            flash('Вход выполнен!')
-            return redirect('/')
-        else:
-            flash('Неверные данные')
+        if User.query.filter_by(username=username).first():
+            flash('Имя пользователя уже занято')
+            return redirect('/register')
+        
+        hashed_password = hash_password(password)
+        user = User(username=username, email=email, password_hash=hashed_password)
+        
+        db.session.add(user)
+        db.session.flush()
+        db.session.add(UserStats(user_id=user.id))
+        db.session.commit()
+        
+        session['user_id'] = user.id
+        session['username'] = user.username
+        flash('Регистрация успешна!')
+        return redirect('/')
     
-    content = '''
+    return render_page("Регистрация", REGISTER_FORM)
+
+LOGIN_FORM = Markup('''
     <div class="row justify-content-center">
         <div class="col-md-6">
             <div class="card">
@@ -267,9 +2262,34 @@ def login():
             </div>
         </div>
     </div>
-    '''
+''')
+
+# Вход
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        username = request.form['username']
+        password = request.form['password']
+        
+        wait = rate_limited((f'login-ip:{request.remote_addr}', 'LOGIN_RATE_LIMIT_IP'),
+                            (f'login-user:{username.lower()}', 'LOGIN_RATE_LIMIT_USER'))
+        if wait:
+            return too_many_attempts("Вход", LOGIN_FORM, wait)
+        
+        user = User.query.filter_by(username=username).first()
+        
+        if user and verify_password(user.password_hash, password):
+            if password_needs_rehash(user.password_hash):
+                user.password_hash = hash_password(password)
+                db.session.commit()
+            session['user_id'] = user.id
+            session['username'] = user.username
+            flash('Вход выполнен!')
+            return redirect('/')
+        else:
+            flash('Неверные данные')
     
-    return render_page("Вход", content)
+    return render_page("Вход", LOGIN_FORM)
 
 # Выход
 @app.route('/logout')
@@ -277,56 +2297,7 @@ def logout():
     session.clear()
     return redirect('/')
 
-# Создание проекта
-@app.route('/create', methods=['GET', 'POST'])
-def create_project():
-    if 'user_id' not in session:
-        return redirect('/login')
-    
-    if request.method == 'POST':
-        title = request.form['title']
-        description = request.form['description']
-        repository_url = request.form['repository_url']
-        languages = request.form['languages']
-        
-        # Создаем папку для файлов проекта
-        import uuid
-        folder_name = str(uuid.uuid4())[:8]
-        project_folder = os.path.join(app.config['UPLOAD_FOLDER'], folder_name)
-        os.makedirs(project_folder, exist_ok=True)
-        
-        project = Project(
-            title=title,
-            description=description,
-            repository_url=repository_url,
-            languages=languages,
-            user_id=session['user_id'],
-            files_folder=folder_name
-        )
-        
-        db.session.add(project)
-        db.session.commit()
-        
-        # Обработка загруженных файлов
-        files = request.files.getlist('files')
-        for file in files:
-            if file and file.filename:
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(project_folder, filename)
-                file.save(filepath)
-                
-                project_file = ProjectFile(
-                    filename=filename,
-                    filepath=os.path.join(folder_name, filename),
-                    project_id=project.id
-                )
-                db.session.add(project_file)
-        
-        db.session.commit()
-        flash('Проект создан!')
-        return redirect(f'/project/{project.id}')
-    
-    content = '''
+CREATE_FORM = Markup('''
     <div class="row justify-content-center">
         <div class="col-md-8">
             <div class="card">
@@ -347,10 +2318,11 @@ def create_project():
                             <input type="url" name="repository_url" class="form-control">
                         </div>
                         <div class="mb-3">
-                            <label class="form-label">Языки программирования *</label>
-                            <input type="text" name="languages" class="form-control" required
+                            <label class="form-label">Языки программирования</label>
+                            <input type="text" name="languages" class="form-control"
                                    placeholder="Python:60, JavaScript:30, HTML:10">
-                            <small class="text-muted">Формат: Язык:процент, Язык:процент (сумма = 100%)</small>
+                            <small class="text-muted">Формат: Язык:процент, Язык:процент (сумма = 100%).
+                                Оставьте пустым, чтобы определить по загруженным файлам</small>
                         </div>
                         <div class="mb-3">
                             <label class="form-label">Файлы проекта</label>
@@ -366,96 +2338,126 @@ def create_project():
             </div>
         </div>
     </div>
-    '''
+''')
+
+# Создание проекта
+@app.route('/create', methods=['GET', 'POST'])
+def create_project():
+    if 'user_id' not in session:
+        return redirect('/login')
+    
+    if request.method == 'POST':
+        title = request.form['title']
+        description = request.form['description']
+        repository_url = request.form['repository_url']
+        try:
+            languages = parse_languages(request.form.get('languages', ''))
+        except ValueError as e:
+            flash(str(e))
+            return redirect('/create')
+        
+        # Создаем папку для файлов проекта
+        folder_name = str(uuid.uuid4())[:8]
+        
+        project = Project(
+            title=title,
+            description=description,
+            repository_url=repository_url,
+            user_id=session['user_id'],
+            files_folder=folder_name,
+            languages_auto=not languages
+        )
+        
+        set_project_languages(project, languages)
+        db.session.add(project)
+        db.session.flush()
+        
+        # Обработка загруженных файлов
+        files = save_uploaded_files(project, request.files.getlist('files'))
+        if files:
+            enqueue_job('build_archive', project_id=project.id)
+            enqueue_job('detect_languages', project_id=project.id)
+        bump_user_stats(db.session, project.user_id, projects=1, files=len(files))
+        
+        db.session.commit()
+        page_cache.invalidate('feed', 'trending', f"user:{session['user_id']}")
+        flash('Проект создан!')
+        return redirect(f'/project/{project.id}')
     
-    return render_page("Создать проект", content)
+    return render_page("Создать проект", CREATE_FORM)
 
-# Страница проекта
-@app.route('/project/<int:project_id>')
-def project_detail(project_id):
-    project = Project.query.get_or_404(project_id)
-    
-    # Создаем HTML для языков
-    langs_html = ""
-    if project.languages:
-        langs = project.languages.split(',')
-        total_width = 0
-        for lang in langs:
-            if ':' in lang:
-                name, perc = lang.split(':')
-                color = f"hsl({hash(name) % 360}, 70%, 50%)"
-                langs_html += f'''
-                <div class="col-6 mb-2">
-                    <div class="d-flex justify-content-between">
-                        <span>{name}</span>
-                        <span>{perc}%</span>
-                    </div>
-                    <div class="language-bar">
-                        <div class="language-fill" style="width: {perc}%; background-color: {color};"></div>
-                    </div>
-                </div>
-                '''
-    
-    # Создаем HTML для файлов
-    files_html = ""
-    for file in project.files:
-        files_html += f'''
-        <div class="file-item">
-            <div class="d-flex justify-content-between align-items-center">
-                <div>
-                    <i class="bi bi-file-earmark"></i>
-                    <span class="ms-2">{file.filename}</span>
-                </div>
-                <div>
-                    <small class="text-muted me-3">{file.upload_date.strftime('%d.%m.%Y')}</small>
-                    <a href="/download/{file.id}" class="btn btn-sm btn-outline-light">
-                        <i class="bi bi-download"></i>
-                    </a>
-                </div>
-            </div>
-        </div>
-        '''
-    
-    # Кнопки управления
-    manage_buttons = ""
-    if 'user_id' in session and session['user_id'] == project.user_id:
-        manage_buttons = f'''
-        <div class="mt-3">
-            <button type="button" class="btn btn-outline-warning" data-bs-toggle="modal" data-bs-target="#addFilesModal">
-                <i class="bi bi-plus-circle"></i> Добавить файлы
-            </button>
-        </div>
-        '''
-    
-    content = f'''
+PROJECT_TEMPLATE = app.jinja_env.from_string('''
     <div class="row">
         <div class="col-md-8">
             <div class="card mb-4">
                 <div class="card-body">
-                    <h1>{project.title}</h1>
-                    <p class="lead">{project.description}</p>
+                    <h1>{{ project.title }}</h1>
+                    <p class="lead">{{ project.description }}</p>
                     
                     <div class="d-flex align-items-center mb-3">
                         <i class="bi bi-person-circle me-2"></i>
-                        <strong>{project.author.username}</strong>
+                        <strong>{{ project.author.username }}</strong>
                         <span class="text-muted ms-3">
                             <i class="bi bi-calendar me-1"></i>
-                            {project.created_at.strftime('%d.%m.%Y')}
+                            {{ project.created_at.strftime('%d.%m.%Y') }}
                         </span>
                         <span class="text-muted ms-3">
                             <i class="bi bi-star me-1"></i>
-                            {project.stars} звёзд
+                            {{ project.stars }} звёзд
                         </span>
                     </div>
                     
-                    {manage_buttons}
+                    {% for job in jobs %}
+                    <div class="small {% if job.status == 'failed' %}text-danger{% else %}text-muted{% endif %}">
+                        <i class="bi bi-gear"></i> {{ job_labels.get(job.kind, job.kind) }}:
+                        {% if job.status == 'queued' and job.attempts %}повтор (попытка {{ job.attempts + 1 }} из {{ job.max_attempts }})
+                        {% elif job.status == 'queued' %}в очереди
+                        {% elif job.status == 'running' %}выполняется
+                        {% else %}ошибка{% endif %}
+                    </div>
+                    {% endfor %}
+                    
+                    {% if is_owner %}
+                    <div class="mt-3">
+                        <button type="button" class="btn btn-outline-warning" data-bs-toggle="modal" data-bs-target="#addFilesModal">
+                            <i class="bi bi-plus-circle"></i> Добавить файлы
+                        </button>
+                    </div>
+                    {% endif %}
                 </div>
             </div>
             
             <div class="card mb-4">
                 <div class="card-body">
-                    <h4><i class="bi bi-files"></i> Файлы проекта</h4>
-                    {files_html if files_html else '<p class="text-muted">Файлов пока нет</p>'}
+                    <div class="d-flex justify-content-between align-items-center">
+                        <h4><i class="bi bi-files"></i> Файлы проекта</h4>
+                        {% if files %}
+                        <a href="/project/{{ project.id }}/archive" class="btn btn-sm btn-outline-light">
+                            <i class="bi bi-file-zip"></i> Скачать всё (ZIP)
+                        </a>
+                        {% endif %}
+                    </div>
+                    {% for file in files %}
+                    <div class="file-item">
+                        <div class="d-flex justify-content-between align-items-center">
+                            <div>
+                                <i class="bi bi-file-earmark"></i>
+                                <span class="ms-2">{{ file.filename }}</span>
+                            </div>
+                            <div>
+                                <small class="text-muted me-3">{{ file.upload_date.strftime('%d.%m.%Y') }}</small>
+                                <a href="/file/{{ file.id }}/preview" class="btn btn-sm btn-outline-light" title="Просмотр">
+                                    <i class="bi bi-eye"></i>
+                                </a>
+                                <a href="/download/{{ file.id }}" class="btn btn-sm btn-outline-light">
+                                    <i class="bi bi-download"></i>
+                                </a>
+                            </div>
+                        </div>
+                    </div>
+                    {% else %}
+                    <p class="text-muted">Файлов пока нет</p>
+                    {% endfor %}
                 </div>
             </div>
         </div>
@@ -465,7 +2467,19 @@ def project_detail(project_id):
                 <div class="card-body">
                     <h4><i class="bi bi-code-slash"></i> Языки</h4>
                     <div class="row">
-                        {langs_html if langs_html else '<p class="text-muted">Языки не указаны</p>'}
+                        {% for lang in project.language_stats %}
+                        <div class="col-6 mb-2">
+                            <div class="d-flex justify-content-between">
+                                <span>{{ lang.name }}</span>
+                                <span>{{ lang.percent }}%</span>
+                            </div>
+                            <div class="language-bar">
+                                <div class="language-fill" style="width: {{ lang.percent }}%; background-color: {{ lang.color }};"></div>
+                            </div>
+                        </div>
+                        {% else %}
+                        <p class="text-muted">Языки не указаны</p>
+                        {% endfor %}
                     </div>
                 </div>
             </div>
@@ -473,8 +2487,10 @@ def project_detail(project_id):
             <div class="card">
                 <div class="card-body">
                     <h4><i class="bi bi-link"></i> Ссылки</h4>
-                    {f'<a href="{project.repository_url}" target="_blank" class="btn btn-outline-light w-100 mb-2"><i class="bi bi-github"></i> Репозиторий</a>' if project.repository_url else ''}
-                    <button class="btn btn-primary w-100" onclick="starProject({project.id})">
+                    {% if project.repository_url %}
+                    <a href="{{ project.repository_url }}" target="_blank" class="btn btn-outline-light w-100 mb-2"><i class="bi bi-github"></i> Репозиторий</a>
+                    {% endif %}
+                    <button class="btn btn-primary w-100" onclick="starProject({{ project.id }})">
                         <i class="bi bi-star"></i> Поставить звезду
                     </button>
                 </div>
@@ -490,7 +2506,7 @@ def project_detail(project_id):
                     <h5 class="modal-title">Добавить файлы</h5>
                     <button type="button" class="btn-close" data-bs-dismiss="modal"></button>
                 </div>
-                <form action="/project/{project.id}/upload" method="POST" enctype="multipart/form-data">
+                <form action="/project/{{ project.id }}/upload" method="POST" enctype="multipart/form-data">
                     <div class="modal-body">
                         <input type="file" name="files" class="form-control" multiple required>
                         <small class="text-muted">Можно выбрать несколько файлов</small>
@@ -505,19 +2521,39 @@ def project_detail(project_id):
     </div>
     
     <script>
-    function starProject(projectId) {{
-        fetch(`/project/${{projectId}}/star`, {{ method: 'POST' }})
+    function starProject(projectId) {
+        fetch(`/project/${projectId}/star`, { method: 'POST' })
             .then(response => response.json())
-            .then(data => {{
-                if (data.success) {{
+            .then(data => {
+                if (data.success) {
                     alert('Звезда добавлена!');
                     location.reload();
-                }}
-            }});
-    }}
+                } else if (data.error) {
+                    alert(data.error);
+                }
+            });
+    }
     </script>
-    '''
-    
+''')
+
+# Страница проекта
+@app.route('/project/<int:project_id>')
+@cached_page(lambda project_id: [f'project:{project_id}'])
+@read_only_route
+def project_detail(project_id):
+    project = Project.query.get_or_404(project_id)
+    # Незавершённые задачи проекта (завершённые успешно не показываем)
+    jobs = db.session.execute(
+        db.select(Job).where(Job.project_id == project_id, Job.status != 'done')
+        .order_by(Job.id.desc()).limit(10)
+    ).scalars().all()
+    content = PROJECT_TEMPLATE.render(
+        project=project,
+        files=project.files,
+        jobs=jobs,
+        job_labels=JOB_LABELS,
+        is_owner='user_id' in session and session['user_id'] == project.user_id,
+    )
     return render_page(project.title, content)
 
 # Загрузка файлов в проект
@@ -533,98 +2569,2090 @@ def upload_files(project_id):
         flash('Нет прав на загрузку файлов')
         return redirect(f'/project/{project_id}')
     
-    files = request.files.getlist('files')
-    for file in files:
-        if file and file.filename:
-            filename = secure_filename(file.filename)
-            project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project.files_folder)
-            filepath = os.path.join(project_folder, filename)
-            file.save(filepath)
-            
-            project_file = ProjectFile(
-                filename=filename,
-                filepath=os.path.join(project.files_folder, filename),
-                project_id=project.id
-            )
-            db.session.add(project_file)
-    
+    files = save_uploaded_files(project, request.files.getlist('files'))
+    if files:
+        enqueue_job('build_archive', project_id=project.id)
+        enqueue_job('detect_languages', project_id=project.id)
+        bump_user_stats(db.session, project.user_id, files=len(files))
+        bump_row_version(db.session, Project, [project.id])
     db.session.commit()
+    page_cache.invalidate('feed', 'trending', f'project:{project.id}', f'user:{project.user_id}')
     flash('Файлы загружены!')
     return redirect(f'/project/{project_id}')
 
-# Скачивание файла
+# Возобновляемая загрузка: клиент создаёт сессию, отправляет части PUT-запросами в любом
+# порядке (повтор уже принятой части ничего не делает), спрашивает, какие части дошли,
+# и завершает загрузку. Сборка файла - хеширование и перенос в хранилище блобов - идёт
+# фоновой задачей, поэтому каждый запрос короткий независимо от размера файла.
+SHA256_RE = re.compile(r'[0-9a-f]{64}')
+
+def resumable_dir():
+    # Внутри UPLOAD_FOLDER, чтобы перенос готового файла в хранилище был атомарным
+    path = os.path.join(app.config['UPLOAD_FOLDER'], '.resumable')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def upload_part_path(upload_id):
+    return os.path.join(resumable_dir(), upload_id)
+
+def upload_chunk_count(upload):
+    return max(1, -(-upload.size // upload.chunk_size))
+
+def upload_chunk_length(upload, number):
+    return min(upload.chunk_size, upload.size - number * upload.chunk_size)
+
+def upload_error(message, code, **extra):
+    abort(app.make_response(({'error': message, **extra}, code)))
+
+def owned_upload(upload_id):
+    if 'user_id' not in session:
+        upload_error('Требуется вход', 401)
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != session['user_id']:
+        upload_error('Загрузка не найдена', 404)
+    return upload
+
+def upload_status(upload):
+    chunks = db.session.execute(
+        db.select(UploadChunk.number, UploadChunk.status)
+        .where(UploadChunk.upload_id == upload.id).order_by(UploadChunk.number)
+    ).all()
+    received = [number for number, status in chunks if status == 'received']
+    # Принятые части отдаются диапазонами байт [начало, конец)
+    ranges = []
+    for number in received:
+        start = number * upload.chunk_size
+        end = start + upload_chunk_length(upload, number)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    done = set(received)
+    return {
+        'id': upload.id,
+        'filename': upload.filename,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'chunks': upload_chunk_count(upload),
+        'received': ranges,
+        'missing': [n for n in range(upload_chunk_count(upload)) if n not in done],
+        'writing': [number for number, status in chunks if status == 'writing'],
+        'status': upload.status,
+        'error': upload.error,
+        'file_id': upload.file_id,
+    }
+
+def write_upload_chunk(path, offset, length):
+    # Пишет тело запроса в файл с нужного смещения блоками, не собирая часть в памяти;
+    # возвращает SHA-256 записанного или None, если тело оборвалось
+    digest = hashlib.sha256()
+    block_size = app.config['UPLOAD_CHUNK_SIZE']
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while length:
+            block = request.stream.read(min(block_size, length))
+            if not block:
+                return None
+            digest.update(block)
+            view = memoryview(block)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+            length -= len(block)
+    finally:
+        os.close(fd)
+    return digest.hexdigest()
+
+@app.route('/project/<int:project_id>/uploads', methods=['POST'])
+def create_upload(project_id):
+    if 'user_id' not in session:
+        upload_error('Требуется вход', 401)
+    project = db.session.get(Project, project_id)
+    if project is None:
+        upload_error('Проект не найден', 404)
+    if project.user_id != session['user_id']:
+        upload_error('Нет прав на загрузку файлов', 403)
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(str(data.get('filename') or ''))
+    if not filename:
+        upload_error('Не указано имя файла', 400)
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        upload_error('Не указан размер файла', 400)
+    if size < 0 or size > app.config['RESUMABLE_MAX_SIZE']:
+        upload_error('Файл слишком большой', 413, max_size=app.config['RESUMABLE_MAX_SIZE'])
+    sha256 = str(data.get('sha256') or '').lower() or None
+    if sha256 is not None and not SHA256_RE.fullmatch(sha256):
+        upload_error('sha256 должен быть шестнадцатеричной строкой из 64 символов', 400)
+    if shutil.disk_usage(resumable_dir()).free < size:
+        upload_error('Недостаточно места для файла', 507)
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        project_id=project.id,
+        user_id=project.user_id,
+        filename=filename,
+        size=size,
+        chunk_size=min(app.config['RESUMABLE_CHUNK_SIZE'], app.config['MAX_CONTENT_LENGTH']),
+        sha256=sha256,
+    )
+    # Разреженный файл нужного размера: части пишутся по своим смещениям в любом порядке
+    with open(upload_part_path(upload.id), 'wb') as f:
+        f.truncate(size)
+    db.session.add(upload)
+    db.session.commit()
+    return upload_status(upload), 201, {'Location': f'/uploads/{upload.id}'}
+
+@app.route('/uploads/<upload_id>')
+def upload_info(upload_id):
+    return upload_status(owned_upload(upload_id))
+
+@app.route('/uploads/<upload_id>/chunks/<int:number>', methods=['PUT'])
+def put_upload_chunk(upload_id, number):
+    upload = owned_upload(upload_id)
+    if upload.status != 'open':
+        upload_error('Загрузка уже завершена', 409, status=upload.status)
+    if number >= upload_chunk_count(upload):
+        upload_error('Нет такой части', 404)
+    length = upload_chunk_length(upload, number)
+    expected = request.headers.get('X-Chunk-SHA256', '').lower()
+    if not SHA256_RE.fullmatch(expected):
+        upload_error('Нужен заголовок X-Chunk-SHA256 с хешем части', 400)
+    if request.content_length != length:
+        upload_error(f'Размер части {number} должен быть {length} байт', 400)
+    chunk_key = (UploadChunk.upload_id == upload_id, UploadChunk.number == number)
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    # Занимаем часть до записи: строка 'writing' с нашей меткой, а условное обновление загрузки
+    # не даст занять часть, если загрузку уже завершили или отменили
+    claimed = db.session.execute(insert_ignore(UploadChunk.__table__).values(
+        upload_id=upload_id, number=number, sha256=expected, status='writing', token=token, updated_at=now)).rowcount
+    if not claimed:
+        existing = db.session.execute(db.select(UploadChunk.sha256, UploadChunk.status).where(*chunk_key)).first()
+        if existing is not None and existing.status == 'received':
+            db.session.rollback()
+            if existing.sha256 != expected:
+                upload_error('Часть уже принята с другим содержимым', 409)
+            return {'number': number, 'received': True}
+        # Запись, брошенная упавшим запросом, освобождается по таймауту
+        stale = datetime.utcfromtimestamp(time.time() - app.config['RESUMABLE_CHUNK_TIMEOUT'])
+        claimed = db.session.execute(
+            db.update(UploadChunk).where(*chunk_key, UploadChunk.status == 'writing', UploadChunk.updated_at < stale)
+            .values(sha256=expected, token=token, updated_at=now)).rowcount
+        if not claimed:
+            db.session.rollback()
+            upload_error('Часть уже загружается другим запросом', 409)
+    opened = db.session.execute(
+        db.update(UploadSession).where(UploadSession.id == upload_id, UploadSession.status == 'open')
+        .values(updated_at=now)).rowcount
+    if not opened:
+        db.session.rollback()
+        upload_error('Загрузка уже завершена', 409)
+    db.session.commit()
+    offset = number * upload.chunk_size
+    # Не держим соединение с базой, пока читается тело запроса
+    db.session.close()
+    try:
+        digest = write_upload_chunk(upload_part_path(upload_id), offset, length)
+    except FileNotFoundError:
+        digest = False
+    if digest != expected:
+        # Освобождаем часть, чтобы клиент мог сразу отправить её заново
+        db.session.execute(db.delete(UploadChunk).where(
+            *chunk_key, UploadChunk.status == 'writing', UploadChunk.token == token))
+        db.session.commit()
+        if digest is False:
+            upload_error('Загрузка отменена', 410)
+        if digest is None:
+            upload_error('Часть получена не полностью', 400)
+        upload_error('Контрольная сумма части не совпала', 400)
+    received = db.session.execute(
+        db.update(UploadChunk).where(*chunk_key, UploadChunk.status == 'writing', UploadChunk.token == token)
+        .values(status='received', token=None, updated_at=datetime.utcnow())).rowcount
+    if not received:
+        # Пока тело читалось слишком долго, часть перехватил другой запрос: он её и допишет
+        db.session.rollback()
+        upload_error('Часть уже загружается другим запросом', 409)
+    db.session.execute(db.update(UploadSession).where(UploadSession.id == upload_id)
+                       .values(updated_at=datetime.utcnow()))
+    db.session.commit()
+    return {'number': number, 'received': True}
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    upload = owned_upload(upload_id)
+    if upload.status in ('finalizing', 'done'):
+        return upload_status(upload), 200 if upload.status == 'done' else 202
+    if upload.status != 'open':
+        upload_error(upload.error or 'Загрузка не удалась', 409, status=upload.status)
+    status = upload_status(upload)
+    if status['missing']:
+        upload_error('Получены не все части', 409, missing=status['missing'])
+    # Условное обновление: повторный запрос не поставит вторую задачу
+    result = db.session.execute(
+        db.update(UploadSession).where(UploadSession.id == upload_id, UploadSession.status == 'open')
+        .values(status='finalizing', error=None, updated_at=datetime.utcnow()))
+    if result.rowcount:
+        enqueue_job('finalize_upload', project_id=upload.project_id, upload_id=upload_id)
+    db.session.commit()
+    db.session.refresh(upload)
+    return upload_status(upload), 202
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    upload = owned_upload(upload_id)
+    if upload.status in ('finalizing', 'done'):
+        upload_error('Загрузка уже завершена', 409, status=upload.status)
+    db.session.execute(db.delete(UploadChunk).where(UploadChunk.upload_id == upload_id))
+    db.session.delete(upload)
+    db.session.commit()
+    try:
+        os.unlink(upload_part_path(upload_id))
+    except FileNotFoundError:
+        pass
+    return {'success': True}
+
+# Скачивание файла: путь к файлу по id кэшируется в процессе, повторные скачивания не ходят в БД
+download_lookup_cache = LRUCache(app.config['DOWNLOAD_LOOKUP_CACHE_SIZE'])
+
+def lookup_download(file_id):
+    entry = download_lookup_cache.get(file_id)
+    if entry is None:
+        row = db.session.execute(
+            db.select(ProjectFile.filepath, ProjectFile.filename, ProjectFile.sha256)
+            .where(ProjectFile.id == file_id)
+        ).first()
+        if row is None:
+            abort(404)
+        entry = tuple(row)
+        download_lookup_cache.set(file_id, entry)
+    return entry
+
+def accel_redirect_response(filepath, filename, sha256):
+    # Заголовки готовит Flask, байты отдаёт nginx (включая Range-запросы)
+    response = Response(mimetype='application/octet-stream')
+    response.headers['X-Accel-Redirect'] = app.config['DOWNLOAD_ACCEL_PREFIX'] + filepath.replace(os.sep, '/')
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    if sha256:
+        response.set_etag(sha256)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['DOWNLOAD_MAX_AGE']
+    response.accept_ranges = 'bytes'
+    return response.make_conditional(request)
+
 @app.route('/download/<int:file_id>')
+@read_only_route
 def download_file(file_id):
-    file_record = ProjectFile.query.get_or_404(file_id)
-    return send_from_directory(
-        directory=app.config['UPLOAD_FOLDER'],
-        path=file_record.filepath,
-        as_attachment=True
+    filepath, filename, sha256 = lookup_download(file_id)
+    if app.config['DOWNLOAD_OFFLOAD'] == 'x-accel':
+        return accel_redirect_response(filepath, filename, sha256)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filepath)
+    if not os.path.isfile(path):
+        # Путь мог устареть (например, после migrate-blobs) - перечитываем из БД
+        download_lookup_cache.pop(file_id)
+        filepath, filename, sha256 = lookup_download(file_id)
+        path = os.path.join(app.config['UPLOAD_FOLDER'], filepath)
+        if not os.path.isfile(path):
+            abort(404)
+    # conditional=True: поддержка Range и ответ 304 по If-None-Match; ETag - хеш содержимого
+    response = send_file(
+        os.path.abspath(path),
+        as_attachment=True,
+        download_name=filename,
+        conditional=True,
+        etag=sha256 or True,
+        max_age=app.config['DOWNLOAD_MAX_AGE'],
+    )
+    # Сообщаем клиенту, что докачка поддерживается
+    response.accept_ranges = 'bytes'
+    return response
+
+# Предпросмотр файла. Файл читается окном через mmap, поэтому большой лог целиком в память
+# воркера не попадает: страница - около PREVIEW_PAGE_SIZE байт, границы страниц сдвигаются
+# к концу строки. Двоичные файлы узнаются по первым килобайтам. Готовый HTML страницы
+# хранится на диске с ключом из хеша содержимого, поэтому один и тот же файл (в том числе
+# в разных проектах) подсвечивается один раз. mtime записи - время последнего обращения:
+# когда кэш больше PREVIEW_CACHE_MAX_BYTES, удаляются самые давние записи.
+PREVIEW_SNIFF_SIZE = 8192
+# Насколько далеко за границей страницы искать конец строки; дальше строка режется
+PREVIEW_LINE_SLACK = 4096
+# Увеличивается при изменении разметки, чтобы старые записи кэша не использовались
+PREVIEW_RENDER_VERSION = 1
+
+def sniff_text_encoding(sample):
+    # None - двоичный файл
+    if b'\0' in sample:
+        return None
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    # Не UTF-8: однобайтовая кодировка, если управляющих символов почти нет
+    control = sum(1 for byte in sample if byte < 32 and byte not in b'\t\n\r\f\b\x1b')
+    return 'cp1251' if control <= len(sample) // 20 else None
+
+def preview_boundary(mm, offset):
+    # Начало строки, следующей за offset; слишком длинная строка режется ровно по offset
+    if offset <= 0:
+        return 0
+    if offset >= len(mm):
+        return len(mm)
+    newline = mm.find(b'\n', offset - 1, offset - 1 + PREVIEW_LINE_SLACK)
+    return offset if newline < 0 else newline + 1
+
+def count_lines(mm, start, end):
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    return sum(mm[pos:min(pos + chunk_size, end)].count(b'\n') for pos in range(start, end, chunk_size))
+
+def page_start_line(mm, number, page_size, checkpoints):
+    # checkpoints - номер страницы -> номер её первой строки. Считаем переводы строк только
+    # от ближайшей известной страницы, попутно запоминая начала промежуточных
+    known = max((n for n in checkpoints if n <= number), default=0)
+    line = checkpoints.get(known, 1)
+    start = preview_boundary(mm, known * page_size)
+    for n in range(known + 1, number + 1):
+        end = preview_boundary(mm, n * page_size)
+        line += count_lines(mm, start, end)
+        checkpoints[n] = line
+        start = end
+    return line
+
+def read_preview_page(path, number, page_size, checkpoints):
+    # (текст страницы, номер её первой строки) или None для двоичного файла;
+    # checkpoints дополняется началами этой и следующей страниц
+    with open(path, 'rb') as f:
+        encoding = sniff_text_encoding(f.read(PREVIEW_SNIFF_SIZE))
+        if encoding is None:
+            return None
+        if os.fstat(f.fileno()).st_size == 0:
+            return '', 1
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            first_line = page_start_line(mm, number, page_size, checkpoints)
+            start = preview_boundary(mm, number * page_size)
+            end = preview_boundary(mm, (number + 1) * page_size)
+            data = mm[start:end]
+            checkpoints[number + 1] = first_line + data.count(b'\n')
+            return data.decode(encoding, errors='replace'), first_line
+
+def preview_lexer(filename):
+    if pygments is None:
+        return None
+    try:
+        return get_lexer_for_filename(filename, stripnl=False, ensurenl=False)
+    except ClassNotFound:
+        return TextLexer(stripnl=False, ensurenl=False)
+
+def render_preview(text, lexer, first_line):
+    if lexer is None:
+        return str(Markup('<pre class="preview-plain">{}</pre>').format(text))
+    formatter = HtmlFormatter(linenos='table', linenostart=first_line, cssclass='highlight')
+    return pygments.highlight(text, lexer, formatter)
+
+@functools.lru_cache(maxsize=1)
+def preview_style_defs():
+    if pygments is None:
+        return ''
+    try:
+        return HtmlFormatter(style=app.config['PREVIEW_STYLE']).get_style_defs('.highlight')
+    except ClassNotFound:
+        return HtmlFormatter().get_style_defs('.highlight')
+
+class PreviewCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # Объём кэша на диске: считается при первой записи, дальше - по своим записям;
+        # другие воркеры пишут в тот же каталог, поэтому вытеснение пересчитывает его заново
+        self.size = None
+        self.lock = threading.Lock()
+
+    def directory(self):
+        return app.config['PREVIEW_CACHE_DIR'] or os.path.join(app.config['UPLOAD_FOLDER'], '.preview')
+
+    def path(self, key, suffix='.html'):
+        return os.path.join(self.directory(), key[:2], key + suffix)
+
+    def get(self, key, suffix='.html'):
+        path = self.path(key, suffix)
+        try:
+            with open(path, encoding='utf-8') as f:
+                html = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return html
+
+    # Номера первых строк страниц файла: {страница: строка}, хранятся рядом со страницами
+    def get_checkpoints(self, key):
+        data = self.get(key, '.lines')
+        return {int(n): line for n, line in json.loads(data).items()} if data else {}
+
+    def set_checkpoints(self, key, checkpoints):
+        self.set(key, json.dumps(checkpoints), '.lines')
+
+    def set(self, key, html, suffix='.html'):
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = html.encode('utf-8')
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.entries())
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        for dirpath, _, filenames in os.walk(self.directory()):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        # Удаляем самые давно открытые записи, пока кэш не станет меньше 90% предела
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+
+preview_cache = PreviewCache(app.config['PREVIEW_CACHE_MAX_BYTES'])
+
+PREVIEW_TEMPLATE = app.jinja_env.from_string('''
+    {% if style_defs %}<style>{{ style_defs }}</style>{% endif %}
+    <div class="d-flex justify-content-between align-items-center mb-3">
+        <div>
+            <h4 class="mb-0"><i class="bi bi-file-earmark-code"></i> {{ file.filename }}</h4>
+            <a href="/project/{{ file.project_id }}" class="text-muted small">{{ file.title }}</a>
+        </div>
+        <a href="/download/{{ file_id }}" class="btn btn-sm btn-outline-light">
+            <i class="bi bi-download"></i> Скачать
+        </a>
+    </div>
+    <div class="card mb-4">
+        <div class="card-body preview">
+            {% if code is none %}
+            <p class="text-muted mb-0">Двоичный файл, предпросмотр недоступен</p>
+            {% else %}
+            {{ code }}
+            {% endif %}
+        </div>
+    </div>
+    {% if pages > 1 and code is not none %}
+    <div class="d-flex justify-content-center align-items-center mb-4">
+        {% if page > 1 %}<a href="?page={{ page - 1 }}" class="btn btn-outline-light me-2">Предыдущая</a>{% endif %}
+        <span class="text-muted mx-2">Страница {{ page }} из {{ pages }}</span>
+        {% if page < pages %}<a href="?page={{ page + 1 }}" class="btn btn-outline-light ms-2">Следующая</a>{% endif %}
+    </div>
+    {% endif %}
+''')
+
+@app.route('/file/<int:file_id>/preview')
+@read_only_route
+def preview_file(file_id):
+    file = db.session.execute(
+        db.select(ProjectFile.filename, ProjectFile.filepath, ProjectFile.size, ProjectFile.sha256,
+                  ProjectFile.project_id, Project.title)
+        .join(Project, Project.id == ProjectFile.project_id)
+        .where(ProjectFile.id == file_id)
+    ).first()
+    if file is None:
+        abort(404)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], file.filepath)
+    if not os.path.isfile(path):
+        abort(404)
+    page_size = app.config['PREVIEW_PAGE_SIZE']
+    size = file.size if file.size is not None else os.path.getsize(path)
+    pages = max(1, -(-size // page_size))
+    page = request.args.get('page', 1, type=int)
+    if not 1 <= page <= pages:
+        abort(404)
+    lexer = preview_lexer(file.filename)
+    key = None
+    if file.sha256:
+        lexer_name = lexer.aliases[0] if lexer is not None else 'plain'
+        key = f'{file.sha256}-{lexer_name}-{page_size}-{page}-v{PREVIEW_RENDER_VERSION}'
+    code = preview_cache.get(key) if key else None
+    if code is None:
+        lines_key = f'{file.sha256}-{page_size}' if file.sha256 else None
+        checkpoints = preview_cache.get_checkpoints(lines_key) if lines_key else {}
+        known = len(checkpoints)
+        preview = read_preview_page(path, page - 1, page_size, checkpoints)
+        if preview is not None:
+            code = render_preview(preview[0], lexer, preview[1])
+            if key:
+                preview_cache.set(key, code)
+            if lines_key and len(checkpoints) != known:
+                preview_cache.set_checkpoints(lines_key, checkpoints)
+    content = PREVIEW_TEMPLATE.render(
+        file=file,
+        file_id=file_id,
+        code=Markup(code) if code is not None else None,
+        style_defs=Markup(preview_style_defs()),
+        page=page,
+        pages=pages,
     )
+    return render_page(file.filename, content)
+
+# Архив проекта: ZIP собирается на лету и сразу уходит клиенту, параллельно
+# записываясь в кэш; версия архива - хеш списка файлов, повторные запросы отдают готовый файл
+class ZipStream:
+    # Несмещаемый поток для zipfile: копит записанные байты до следующей выдачи клиенту
+    def __init__(self, cache_file):
+        self.chunks = []
+        self.cache_file = cache_file
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.cache_file.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def archive_entries(project_id):
+    # При повторной загрузке файла с тем же именем в архив попадает последняя версия
+    entries = {}
+    rows = db.session.execute(
+        db.select(ProjectFile.filename, ProjectFile.filepath, ProjectFile.sha256,
+                  ProjectFile.size, ProjectFile.upload_date)
+        .where(ProjectFile.project_id == project_id)
+        .order_by(ProjectFile.id)
+    ).all()
+    for row in rows:
+        entries[row.filename] = row
+    return list(entries.values())
+
+def archive_version(entries):
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update(f'{entry.filename}\0{entry.sha256 or entry.filepath}\n'.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def archive_dir():
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'archives')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def generate_archive(project_id, entries, cache_path):
+    upload_folder = app.config['UPLOAD_FOLDER']
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix='.archive-')
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as cache_file:
+            sink = ZipStream(cache_file)
+            with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=app.config['ARCHIVE_COMPRESSLEVEL'], allowZip64=True) as archive:
+                for entry in entries:
+                    info = zipfile.ZipInfo(entry.filename, date_time=entry.upload_date.timetuple()[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    force_zip64 = (entry.size or 0) >= zipfile.ZIP64_LIMIT
+                    with open(os.path.join(upload_folder, entry.filepath), 'rb') as src, \
+                            archive.open(info, 'w', force_zip64=force_zip64) as dst:
+                        for chunk in iter(lambda: src.read(chunk_size), b''):
+                            dst.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+                    yield sink.drain()
+            yield sink.drain()
+        # Старые версии архива этого проекта больше не нужны
+        prefix = f'{project_id}-'
+        for name in os.listdir(os.path.dirname(cache_path)):
+            if name.startswith(prefix) and name.endswith('.zip'):
+                os.unlink(os.path.join(os.path.dirname(cache_path), name))
+        os.replace(tmp_path, cache_path)
+        completed = True
+    finally:
+        # Клиент оборвал соединение или файл не прочитался - недописанный архив не кэшируем
+        if not completed and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+@job_handler('build_archive', 'Сборка архива')
+def build_archive_job(project_id):
+    # Заранее собирает архив, чтобы первое скачивание было отдачей готового файла
+    entries = archive_entries(project_id)
+    if not entries:
+        return
+    cache_path = os.path.join(archive_dir(), f'{project_id}-{archive_version(entries)}.zip')
+    if not os.path.exists(cache_path):
+        for _ in generate_archive(project_id, entries, cache_path):
+            pass
+
+@job_handler('detect_languages', 'Определение языков')
+def detect_languages_job(project_id, batch_size=500):
+    upload_folder = app.config['UPLOAD_FOLDER']
+    # Инкрементально: определяем язык только у файлов, которые ещё не просматривались
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select(ProjectFile.id, ProjectFile.filename, ProjectFile.filepath)
+            .where(ProjectFile.project_id == project_id, ProjectFile.language.is_(None),
+                   ProjectFile.id > last_id)
+            .order_by(ProjectFile.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        db.session.execute(
+            db.update(ProjectFile),
+            [{'id': row.id, 'language': detect_file_language(row.filename, os.path.join(upload_folder, row.filepath))}
+             for row in rows],
+        )
+        bump_row_version(db.session, Project, [project_id])
+        db.session.commit()
+    project = db.session.get(Project, project_id)
+    if project is None or not project.languages_auto:
+        return
+    # Суммы считает БД; из повторно загруженных файлов с одинаковым именем учитывается последний
+    latest = (db.select(db.func.max(ProjectFile.id))
+              .where(ProjectFile.project_id == project_id)
+              .group_by(ProjectFile.filename))
+    totals = dict(db.session.execute(
+        db.select(ProjectFile.language, db.func.sum(ProjectFile.size))
+        .where(ProjectFile.id.in_(latest), ProjectFile.language != '')
+        .group_by(ProjectFile.language)
+    ).all())
+    pairs = language_breakdown({name: size or 0 for name, size in totals.items()})
+    if format_languages(pairs) != (project.languages or ''):
+        set_project_languages(project, pairs)
+        bump_row_version(db.session, Project, [project_id])
+        db.session.commit()
+        page_cache.invalidate('feed', 'trending', f'project:{project_id}', f'user:{project.user_id}')
+
+# Номера частей, содержимое которых на диске не совпадает с хешем, принятым при загрузке
+def damaged_upload_chunks(upload, path):
+    chunks = db.session.execute(
+        db.select(UploadChunk.number, UploadChunk.sha256)
+        .where(UploadChunk.upload_id == upload.id).order_by(UploadChunk.number)
+    ).all()
+    block_size = app.config['UPLOAD_CHUNK_SIZE']
+    damaged = []
+    with open(path, 'rb') as f:
+        for number, sha256 in chunks:
+            f.seek(number * upload.chunk_size)
+            digest = hashlib.sha256()
+            length = upload_chunk_length(upload, number)
+            while length:
+                block = f.read(min(block_size, length))
+                if not block:
+                    break
+                digest.update(block)
+                length -= len(block)
+            if length or digest.hexdigest() != sha256:
+                damaged.append(number)
+    return damaged
+
+def finalize_upload_failed(error, project_id, upload_id):
+    # Задача сборки исчерпала попытки: загрузка больше не ждёт сборки, файл части удалит gc-blobs
+    db.session.execute(
+        db.update(UploadSession).where(UploadSession.id == upload_id, UploadSession.status == 'finalizing')
+        .values(status='failed', error=f'Не удалось собрать файл: {error}', updated_at=datetime.utcnow()))
+    db.session.commit()
+
+@job_handler('finalize_upload', 'Сборка загруженного файла', on_failure=finalize_upload_failed)
+def finalize_upload_job(project_id, upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.status != 'finalizing':
+        return
+    path = upload_part_path(upload_id)
+    if upload.blob_sha256 is None:
+        sha256, size = hash_file(path)
+        if size != upload.size or (upload.sha256 and sha256 != upload.sha256):
+            damaged = damaged_upload_chunks(upload, path)
+            if damaged:
+                # Испорченные части снова считаются недостающими, остальные клиенту не нужно слать заново
+                db.session.execute(db.delete(UploadChunk).where(
+                    UploadChunk.upload_id == upload_id, UploadChunk.number.in_(damaged)))
+                upload.status = 'open'
+                upload.error = f'Части {", ".join(map(str, damaged))} повреждены, отправьте их заново'
+            else:
+                upload.status = 'failed'
+                upload.error = 'Контрольная сумма файла не совпала'
+            upload.updated_at = datetime.utcnow()
+            db.session.commit()
+            return
+        # Хеш запоминаем до переноса: если задача упадёт после него, повтор найдёт блоб
+        upload.blob_sha256 = sha256
+        db.session.commit()
+    sha256 = upload.blob_sha256
+    if os.path.exists(path):
+        relpath = store_blob(path, sha256)
+    else:
+        relpath = blob_relpath(sha256)
+    add_blob_refs({sha256: (upload.size, 1)})
+    file = ProjectFile(filename=upload.filename, filepath=relpath, size=upload.size,
+                       sha256=sha256, blob_sha256=sha256, project_id=project_id)
+    db.session.add(file)
+    db.session.flush()
+    bump_user_stats(db.session, upload.user_id, files=1)
+    bump_row_version(db.session, Project, [project_id])
+    enqueue_job('build_archive', project_id=project_id)
+    enqueue_job('detect_languages', project_id=project_id)
+    db.session.execute(db.delete(UploadChunk).where(UploadChunk.upload_id == upload_id))
+    upload.status = 'done'
+    upload.file_id = file.id
+    upload.updated_at = datetime.utcnow()
+    db.session.commit()
+    page_cache.invalidate('feed', 'trending', f'user:{upload.user_id}')
+
+@app.route('/project/<int:project_id>/archive')
+@read_only_route
+def project_archive(project_id):
+    title = db.session.execute(db.select(Project.title).where(Project.id == project_id)).scalar()
+    if title is None:
+        abort(404)
+    entries = archive_entries(project_id)
+    if not entries:
+        abort(404)
+    version = archive_version(entries)
+    download_name = f'{secure_filename(title) or "project"}-{project_id}.zip'
+    cache_path = os.path.join(archive_dir(), f'{project_id}-{version}.zip')
+    if os.path.exists(cache_path):
+        return send_file(
+            os.path.abspath(cache_path),
+            mimetype='application/zip',
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True,
+            etag=version,
+        )
+    if request.if_none_match.contains(version):
+        return Response(status=304)
+    response = Response(generate_archive(project_id, entries, cache_path), mimetype='application/zip',
+                        direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(version)
+    return response
+
+# Тренды
+# Звёзды, затухшие сильнее этого (в звёздах на момент пересчёта), выпадают из /trending
+TRENDING_MIN_SCORE = 0.01
+
+def trending_epoch(conn):
+    # FOR UPDATE: на PostgreSQL запись звёзд и перенос epoch не пересекаются;
+    # в SQLite транзакции записи и так идут по одной
+    query = db.select(TrendingState.epoch).where(TrendingState.id == 1).with_for_update()
+    epoch = conn.execute(query).scalar()
+    if epoch is None:
+        conn.execute(insert_ignore(TrendingState.__table__).values(id=1, epoch=time.time()))
+        epoch = conn.execute(query).scalar()
+    return epoch
+
+def star_weight(timestamp, epoch):
+    return 2.0 ** ((timestamp - epoch) / app.config['TRENDING_HALF_LIFE'])
+
+def decay_trending(conn, force=False):
+    # Переносит epoch на текущее время; возвращает True, если пересчёт был
+    now = time.time()
+    epoch = trending_epoch(conn)
+    if not force and now - epoch < app.config['TRENDING_DECAY_INTERVAL']:
+        return False
+    # Условное обновление: из нескольких воркеров пересчёт выполнит только один
+    result = conn.execute(db.update(TrendingState)
+                          .where(TrendingState.id == 1, TrendingState.epoch == epoch).values(epoch=now))
+    if not result.rowcount:
+        return False
+    conn.execute(db.update(Project).where(Project.trending_score > 0)
+                 .values(trending_score=Project.trending_score * star_weight(epoch, now)))
+    conn.execute(db.update(Project).where(Project.trending_score > 0,
+                                          Project.trending_score < TRENDING_MIN_SCORE)
+                 .values(trending_score=0))
+    return True
+
+def rebuild_trending(conn, batch_size=1000):
+    # Полный пересчёт оценок по журналу звёзд; звёзды старше 20 периодов полураспада
+    # весят меньше миллионной доли и не учитываются
+    now = time.time()
+    since = datetime.utcfromtimestamp(now - 20 * app.config['TRENDING_HALF_LIFE'])
+    scores = collections.Counter()
+    rows = conn.execute(db.select(ProjectStar.project_id, ProjectStar.created_at)
+                        .where(ProjectStar.created_at >= since))
+    for project_id, created_at in rows:
+        timestamp = (created_at - datetime(1970, 1, 1)).total_seconds()
+        scores[project_id] += star_weight(timestamp, now)
+    conn.execute(db.update(Project).where(Project.trending_score != 0).values(trending_score=0))
+    trending_epoch(conn)
+    conn.execute(db.update(TrendingState).where(TrendingState.id == 1).values(epoch=now))
+    items = [{'id': project_id, 'score': score} for project_id, score in scores.items()
+             if score >= TRENDING_MIN_SCORE]
+    for start in range(0, len(items), batch_size):
+        conn.execute(db.text('UPDATE project SET trending_score = :score WHERE id = :id'),
+                     items[start:start + batch_size])
+    return len(items)
+
+def trending_projects(limit=None):
+    # Одна выборка по индексу ix_project_trending, без сортировки всех проектов
+    return db.session.execute(
+        db.select(Project, file_count_subquery())
+        .options(joinedload(Project.author), selectinload(Project.language_stats))
+        .where(Project.trending_score > 0)
+        .order_by(Project.trending_score.desc(), Project.id.desc())
+        .limit(limit or app.config['TRENDING_SIZE'])
+    ).all()
+
+TRENDING_TEMPLATE = app.jinja_env.from_string('''
+    <h1><i class="bi bi-fire"></i> В тренде</h1>
+    <p class="text-muted">Проекты, которые чаще всего отмечают звёздами в последнее время</p>
+    
+    <div class="row mt-4">
+''' + PROJECT_CARDS + '''
+        {% if not rows %}<div class="alert alert-info">Пока никто не ставил звёзд</div>{% endif %}
+    </div>
+''')
+
+@app.route('/trending')
+@cached_page(lambda: ['trending'], stale_seconds=app.config['FEED_STALE_SECONDS'])
+@read_only_route
+def trending():
+    content = TRENDING_TEMPLATE.render(rows=trending_projects())
+    return render_page("В тренде", content)
+
+# Звёзды: дедупликация по пользователю и атомарный счётчик в SQL
+def apply_stars(conn, pairs):
+    # pairs - список (user_id, project_id); повторные звёзды отбрасывает уникальный индекс
+    now = datetime.utcnow()
+    added = {}
+    stmt = insert_ignore(ProjectStar.__table__)
+    for user_id, project_id in pairs:
+        result = conn.execute(stmt.values(user_id=user_id, project_id=project_id, created_at=now))
+        if result.rowcount:
+            added[project_id] = added.get(project_id, 0) + 1
+    if added:
+        # epoch читаем после вставок, уже внутри транзакции записи
+        weight = star_weight(time.time(), trending_epoch(conn))
+        conn.execute(
+            db.text('UPDATE project SET stars = COALESCE(stars, 0) + :n, '
+                    'trending_score = COALESCE(trending_score, 0) + :score, '
+                    'row_version = row_version + 1, updated_at = :now WHERE id = :id')
+            .bindparams(db.bindparam('now', type_=db.DateTime)),
+            [{'id': project_id, 'n': n, 'score': n * weight, 'now': now} for project_id, n in added.items()],
+        )
+        conn.execute(
+            db.text('UPDATE user_stats SET star_count = star_count + :n '
+                    'WHERE user_id = (SELECT user_id FROM project WHERE id = :id)'),
+            [{'id': project_id, 'n': n} for project_id, n in added.items()],
+        )
+    return added
+
+def project_page_tags(conn, project_ids):
+    # Звёзды видны в ленте, на странице проекта и в профиле автора
+    owners = conn.execute(
+        db.select(Project.user_id).where(Project.id.in_(project_ids)).distinct()
+    ).scalars().all()
+    return ['feed', 'trending', *(f'project:{project_id}' for project_id in project_ids),
+            *(f'user:{user_id}' for user_id in owners)]
+
+class StarBuffer:
+    # Накапливает звёзды в памяти и раз в interval секунд пишет их одной транзакцией:
+    # на каждый проект уходит один UPDATE stars = stars + n вместо записи на каждый клик
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def add(self, user_id, project_id):
+        with self.lock:
+            if (user_id, project_id) in self.pending:
+                return False
+            self.pending[(user_id, project_id)] = True
+        self.ensure_started()
+        return True
+
+    def ensure_started(self):
+        # Поток не переживает fork, поэтому проверяем pid процесса
+        if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name='star-flusher', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Не удалось записать звёзды')
+
+    def flush(self):
+        with self.lock:
+            pairs, self.pending = list(self.pending), {}
+        if not pairs:
+            return {}
+        try:
+            with app.app_context(), db.engine.begin() as conn:
+                added = apply_stars(conn, pairs)
+                tags = project_page_tags(conn, list(added)) if added else []
+            # Инвалидируем после коммита, иначе страница может закэшироваться со старыми данными
+            page_cache.invalidate(*tags)
+            return added
+        except Exception:
+            # Возвращаем звёзды в очередь, чтобы не потерять их при сбое записи
+            with self.lock:
+                for pair in pairs:
+                    self.pending.setdefault(pair, True)
+            raise
+
+star_buffer = StarBuffer(app.config['STAR_FLUSH_INTERVAL'])
+# Сбрасываем накопленные звёзды при остановке процесса
+atexit.register(star_buffer.flush)
+
+def has_starred(user_id, project_id):
+    return db.session.execute(
+        db.select(ProjectStar.id).filter_by(user_id=user_id, project_id=project_id)
+    ).first() is not None
 
 # Добавление звезды проекту
 @app.route('/project/<int:project_id>/star', methods=['POST'])
 def star_project(project_id):
-    project = Project.query.get_or_404(project_id)
-    project.stars += 1
-    db.session.commit()
-    return {'success': True}
-
-# Профиль пользователя
-@app.route('/profile')
-def profile():
     if 'user_id' not in session:
-        return redirect('/login')
+        return {'success': False, 'error': 'Войдите, чтобы ставить звёзды'}, 401
     
-    user = User.query.get(session['user_id'])
-    projects = Project.query.filter_by(user_id=user.id).all()
+    if db.session.execute(db.select(Project.id).filter_by(id=project_id)).first() is None:
+        abort(404)
     
-    projects_html = ""
-    for project in projects:
-        projects_html += f'''
-        <div class="card mb-3">
-            <div class="card-body">
-                <h5>{project.title}</h5>
-                <p class="text-muted">{project.description[:100]}...</p>
-                <div class="d-flex justify-content-between">
-                    <small><i class="bi bi-star"></i> {project.stars} звёзд</small>
-                    <small><i class="bi bi-folder"></i> {len(project.files)} файлов</small>
-                    <small>{project.created_at.strftime('%d.%m.%Y')}</small>
-                </div>
-                <a href="/project/{project.id}" class="btn btn-sm btn-primary mt-2">Подробнее</a>
-            </div>
-        </div>
-        '''
+    user_id = session['user_id']
+    if has_starred(user_id, project_id):
+        return {'success': False, 'error': 'Вы уже поставили звезду'}
+    
+    if star_buffer.interval > 0:
+        if not star_buffer.add(user_id, project_id):
+            return {'success': False, 'error': 'Вы уже поставили звезду'}
+        return {'success': True}
     
-    content = f'''
+    db.session.close()
+    with db.engine.begin() as conn:
+        added = apply_stars(conn, [(user_id, project_id)])
+        tags = project_page_tags(conn, [project_id]) if added else []
+    page_cache.invalidate(*tags)
+    if not added:
+        return {'success': False, 'error': 'Вы уже поставили звезду'}
+    return {'success': True}
+
+PROFILE_TEMPLATE = app.jinja_env.from_string('''
     <div class="row">
         <div class="col-md-4">
             <div class="card">
                 <div class="card-body text-center">
                     <h3><i class="bi bi-person-circle"></i></h3>
-                    <h4>{user.username}</h4>
-                    <p class="text-muted">{user.email}</p>
-                    <div class="stats-box p-3">
-                        <h5>{len(projects)}</h5>
-                        <p class="text-muted">Проектов</p>
+                    <h4>{{ user.username }}</h4>
+                    <p class="text-muted">{{ user.email }}</p>
+                    <div class="row g-2">
+                        <div class="col-4"><div class="stats-box p-3">
+                            <h5>{{ stats.project_count }}</h5>
+                            <p class="text-muted mb-0">Проектов</p>
+                        </div></div>
+                        <div class="col-4"><div class="stats-box p-3">
+                            <h5>{{ stats.star_count }}</h5>
+                            <p class="text-muted mb-0">Звёзд</p>
+                        </div></div>
+                        <div class="col-4"><div class="stats-box p-3">
+                            <h5>{{ stats.file_count }}</h5>
+                            <p class="text-muted mb-0">Файлов</p>
+                        </div></div>
                     </div>
-                    <p class="text-muted mt-3">На Entard с {user.created_at.strftime('%d.%m.%Y')}</p>
+                    <p class="text-muted mt-3">На Entard с {{ user.created_at.strftime('%d.%m.%Y') }}</p>
                 </div>
             </div>
         </div>
         
         <div class="col-md-8">
             <h3>Мои проекты</h3>
-            {projects_html if projects_html else '<div class="alert alert-info">У вас пока нет проектов</div>'}
+            {% for project, files_count in rows %}
+            <div class="card mb-3">
+                <div class="card-body">
+                    <h5>{{ project.title }}</h5>
+                    <p class="text-muted">{{ project.description[:100] }}...</p>
+                    <div class="d-flex justify-content-between">
+                        <small><i class="bi bi-star"></i> {{ project.stars }} звёзд</small>
+                        <small><i class="bi bi-folder"></i> {{ files_count }} файлов</small>
+                        <small>{{ project.created_at.strftime('%d.%m.%Y') }}</small>
+                    </div>
+                    <a href="/project/{{ project.id }}" class="btn btn-sm btn-primary mt-2">Подробнее</a>
+                </div>
+            </div>
+            {% else %}
+            <div class="alert alert-info">У вас пока нет проектов</div>
+            {% endfor %}
             <a href="/create" class="btn btn-primary mt-3">
                 <i class="bi bi-plus-lg"></i> Создать новый проект
             </a>
         </div>
     </div>
-    '''
+''')
+
+# Профиль пользователя
+@app.route('/profile')
+@cached_page(lambda: [f"user:{session.get('user_id')}"])
+@read_only_route
+def profile():
+    if 'user_id' not in session:
+        return redirect('/login')
     
+    user = current_user()
+    if user is None:
+        session.clear()
+        return redirect('/login')
+    stats = db.session.execute(
+        db.select(UserStats.project_count, UserStats.star_count, UserStats.file_count)
+        .where(UserStats.user_id == user.id)
+    ).first()
+    if stats is None:
+        # Строки счётчиков нет (пользователь создан в обход приложения) - считаем по данным
+        stats = db.session.execute(user_stats_select().where(User.id == user.id)).first()
+    rows = db.session.execute(
+        db.select(Project, file_count_subquery())
+        .filter_by(user_id=user.id)
+        .order_by(Project.created_at.desc())
+    ).all()
+    content = PROFILE_TEMPLATE.render(user=user, stats=stats, rows=rows)
     return render_page(f"Профиль {user.username}", content)
 
+# JSON API /api/v1 только для чтения. Списки листаются курсором (id последней записи),
+# ?ids=1,2,3 отдаёт много записей одним запросом, ?fields=id,title,stars выбирает поля - в SQL
+# попадают только нужные колонки. Строки читаются через Core, без сборки ORM-объектов.
+# ETag и Last-Modified строятся из row_version и updated_at; на условный запрос сначала
+# читаются только версии строк, и если они не изменились, ответ - 304 без выборки полей.
+def api_error(message, status):
+    abort(app.make_response(({'error': message}, status)))
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+def api_languages(project_ids):
+    # Языки всех проектов страницы одним запросом по project_language
+    languages = {}
+    if project_ids:
+        rows = db.session.execute(
+            db.select(ProjectLanguage.project_id, ProjectLanguage.name, ProjectLanguage.percent)
+            .where(ProjectLanguage.project_id.in_(project_ids))
+            .order_by(ProjectLanguage.project_id, ProjectLanguage.position)
+        )
+        for project_id, name, percent in rows:
+            languages.setdefault(project_id, []).append({'name': name, 'percent': percent})
+    return languages
+
+# Поле -> (выражение SQL, преобразование значения или None[, загрузка для всей страницы]).
+# У полей с загрузкой колонка - ключ, а значения читаются одним запросом по ключам всех строк
+API_PROJECT_FIELDS = {
+    'id': (Project.id, None),
+    'title': (Project.title, None),
+    'description': (Project.description, None),
+    'repository_url': (Project.repository_url, None),
+    'languages': (Project.id, None, api_languages),
+    'stars': (Project.stars, None),
+    'file_count': (file_count_subquery(), None),
+    'user_id': (Project.user_id, None),
+    # Имя автора берётся join'ом; имена пользователей не меняются, поэтому версия автора в ETag не нужна
+    'author': (User.username, None),
+    'created_at': (Project.created_at, isoformat),
+    'updated_at': (Project.updated_at, isoformat),
+}
+API_USER_FIELDS = {
+    'id': (User.id, None),
+    'username': (User.username, None),
+    'created_at': (User.created_at, isoformat),
+    'updated_at': (User.updated_at, isoformat),
+}
+API_FILE_FIELDS = {
+    'id': (ProjectFile.id, None),
+    'project_id': (ProjectFile.project_id, None),
+    'filename': (ProjectFile.filename, None),
+    'size': (ProjectFile.size, None),
+    'sha256': (ProjectFile.sha256, None),
+    'language': (ProjectFile.language, None),
+    'upload_date': (ProjectFile.upload_date, isoformat),
+    'download_url': (ProjectFile.id, lambda file_id: f'/download/{file_id}'),
+}
+
+def api_fields(spec):
+    fields = request.args.get('fields')
+    if not fields:
+        return list(spec)
+    names = list(dict.fromkeys(name.strip() for name in fields.split(',') if name.strip()))
+    unknown = [name for name in names if name not in spec]
+    if unknown or not names:
+        api_error(f"Неизвестные поля: {', '.join(unknown)}; доступны: {', '.join(spec)}", 400)
+    return names
+
+def api_select(spec, names, key, version, updated):
+    # Последние три колонки - ключ строки, её версия и время изменения для ETag
+    return db.select(*(spec[name][0].label(name) for name in names),
+                     key.label('api_key'), version.label('api_version'), updated.label('api_updated'))
+
+def api_items(spec, names, rows):
+    columns = [(i, name, spec[name][1]) for i, name in enumerate(names)]
+    items = [{name: convert(row[i]) if convert else row[i] for i, name, convert in columns} for row in rows]
+    for i, name in enumerate(names):
+        if len(spec[name]) > 2:
+            values = spec[name][2](list({row[i] for row in rows}))
+            for item in items:
+                item[name] = values.get(item[name], [])
+    return items
+
+def api_etag(versions):
+    # Ответ зависит от пути с параметрами (поля, курсор, ids) и версий попавших в него строк
+    data = repr((request.full_path, sorted(tuple(v) for v in versions)))
+    return hashlib.sha1(data.encode()).hexdigest()
+
+def api_last_modified(versions):
+    return max((v[2] for v in versions if v[2] is not None), default=None)
+
+def api_versions(version_query):
+    # Версии строк нужны заранее только условному запросу
+    if request.if_none_match or request.if_modified_since:
+        return db.session.execute(version_query).all()
+    return None
+
+def api_not_modified(versions):
+    # Ответ 304, если версии не изменились; None - нужно отдавать данные
+    if versions is None:
+        return None
+    etag = api_etag(versions)
+    if is_resource_modified(request.environ, etag=etag, last_modified=api_last_modified(versions)):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.cache_control.no_cache = True
+    return response
+
+def api_response(payload, rows):
+    # У строк последние три колонки - ключ, версия и время изменения
+    versions = [row[-3:] for row in rows]
+    response = app.make_response(payload)
+    response.set_etag(api_etag(versions), weak=True)
+    response.last_modified = api_last_modified(versions)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def api_ids():
+    try:
+        ids = list(dict.fromkeys(int(value) for value in request.args['ids'].split(',') if value.strip()))
+    except ValueError:
+        api_error('ids - список чисел через запятую', 400)
+    if not ids or len(ids) > app.config['API_MAX_PAGE_SIZE']:
+        api_error(f"ids: от 1 до {app.config['API_MAX_PAGE_SIZE']} значений", 400)
+    return ids
+
+def api_page(query, key, descending=True):
+    limit = max(1, min(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int),
+                       app.config['API_MAX_PAGE_SIZE']))
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            api_error('Неверный курсор', 400)
+        query = query.where(key < cursor if descending else key > cursor)
+    rows = db.session.execute(
+        query.order_by(key.desc() if descending else key).limit(limit + 1)
+    ).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1][-3])
+    return rows, next_cursor
+
+def api_bulk(model, spec, names, query):
+    ids = api_ids()
+    not_modified = api_not_modified(api_versions(
+        db.select(model.id, model.row_version, model.updated_at).where(model.id.in_(ids))))
+    if not_modified is not None:
+        return not_modified
+    found = {row[-3]: row for row in db.session.execute(query.where(model.id.in_(ids)))}
+    rows = [found[i] for i in ids if i in found]
+    return api_response({'items': api_items(spec, names, rows),
+                         'missing': [i for i in ids if i not in found]}, rows)
+
+def api_one(model, spec, names, query, object_id):
+    not_modified = api_not_modified(api_versions(
+        db.select(model.id, model.row_version, model.updated_at).where(model.id == object_id)))
+    if not_modified is not None:
+        return not_modified
+    row = db.session.execute(query.where(model.id == object_id)).first()
+    if row is None:
+        api_error('Не найдено', 404)
+    return api_response(api_items(spec, names, [row])[0], [row])
+
+def api_project_query(names):
+    query = api_select(API_PROJECT_FIELDS, names, Project.id, Project.row_version, Project.updated_at)
+    if 'author' in names:
+        query = query.join(User, User.id == Project.user_id)
+    return query
+
+def api_user_query(names):
+    return api_select(API_USER_FIELDS, names, User.id, User.row_version, User.updated_at)
+
+def api_file_query(names):
+    # Версия файла - версия его проекта
+    return (api_select(API_FILE_FIELDS, names, ProjectFile.id, Project.row_version, Project.updated_at)
+            .join(Project, Project.id == ProjectFile.project_id))
+
+@app.route('/api/v1/projects')
+@read_only_route
+def api_projects():
+    names = api_fields(API_PROJECT_FIELDS)
+    query = api_project_query(names)
+    if 'ids' in request.args:
+        return api_bulk(Project, API_PROJECT_FIELDS, names, query)
+    user_id = request.args.get('user_id', type=int)
+    if user_id is not None:
+        query = query.where(Project.user_id == user_id)
+    rows, next_cursor = api_page(query, Project.id)
+    return api_response({'items': api_items(API_PROJECT_FIELDS, names, rows), 'next_cursor': next_cursor}, rows)
+
+@app.route('/api/v1/projects/<int:project_id>')
+@read_only_route
+def api_project(project_id):
+    names = api_fields(API_PROJECT_FIELDS)
+    return api_one(Project, API_PROJECT_FIELDS, names, api_project_query(names), project_id)
+
+@app.route('/api/v1/projects/<int:project_id>/files')
+@read_only_route
+def api_project_files(project_id):
+    names = api_fields(API_FILE_FIELDS)
+    # Добавление файлов и определение их языков увеличивают версию проекта,
+    # поэтому ETag страницы файлов строится по ней
+    versions = db.session.execute(
+        db.select(Project.id, Project.row_version, Project.updated_at).where(Project.id == project_id)
+    ).all()
+    if not versions:
+        api_error('Не найдено', 404)
+    not_modified = api_not_modified(versions)
+    if not_modified is not None:
+        return not_modified
+    rows, next_cursor = api_page(api_file_query(names).where(ProjectFile.project_id == project_id),
+                                 ProjectFile.id, descending=False)
+    return api_response({'items': api_items(API_FILE_FIELDS, names, rows), 'next_cursor': next_cursor}, versions)
+
+@app.route('/api/v1/files/<int:file_id>')
+@read_only_route
+def api_file(file_id):
+    names = api_fields(API_FILE_FIELDS)
+    not_modified = api_not_modified(api_versions(
+        db.select(ProjectFile.id, Project.row_version, Project.updated_at)
+        .join(Project, Project.id == ProjectFile.project_id).where(ProjectFile.id == file_id)))
+    if not_modified is not None:
+        return not_modified
+    row = db.session.execute(api_file_query(names).where(ProjectFile.id == file_id)).first()
+    if row is None:
+        api_error('Не найдено', 404)
+    return api_response(api_items(API_FILE_FIELDS, names, [row])[0], [row])
+
+@app.route('/api/v1/users')
+@read_only_route
+def api_users():
+    names = api_fields(API_USER_FIELDS)
+    query = api_user_query(names)
+    if 'ids' in request.args:
+        return api_bulk(User, API_USER_FIELDS, names, query)
+    rows, next_cursor = api_page(query, User.id)
+    return api_response({'items': api_items(API_USER_FIELDS, names, rows), 'next_cursor': next_cursor}, rows)
+
+@app.route('/api/v1/users/<int:user_id>')
+@read_only_route
+def api_user(user_id):
+    names = api_fields(API_USER_FIELDS)
+    return api_one(User, API_USER_FIELDS, names, api_user_query(names), user_id)
+
+# Управление миграциями: flask db upgrade / downgrade / current / history
+db_cli = AppGroup('db', help='Миграции схемы базы данных.')
+
+@db_cli.command('upgrade')
+@click.option('--to', 'target', type=int, help='Номер миграции (по умолчанию последняя)')
+def db_upgrade_command(target):
+    """Применить миграции."""
+    db.create_all()
+    applied = upgrade_schema(target)
+    for version, name in applied:
+        click.echo(f'+ {version:04d} {name}')
+    if not applied:
+        click.echo('Схема уже актуальна')
+
+@db_cli.command('downgrade')
+@click.option('--to', 'target', type=int, required=True, help='Номер миграции, до которой откатить (0 - все)')
+def db_downgrade_command(target):
+    """Откатить миграции."""
+    for version, name in downgrade_schema(target):
+        click.echo(f'- {version:04d} {name}')
+
+@db_cli.command('current')
+def db_current_command():
+    """Показать номер текущей миграции."""
+    with db.engine.connect() as conn:
+        click.echo(schema_version(conn))
+
+@db_cli.command('history')
+def db_history_command():
+    """Показать список миграций."""
+    with db.engine.connect() as conn:
+        current = schema_version(conn)
+    for version, name, _, _ in MIGRATIONS:
+        mark = '*' if version <= current else ' '
+        click.echo(f'{mark} {version:04d} {name}')
+
+app.cli.add_command(db_cli)
+
+@app.cli.command('worker')
+@click.option('--threads', default=4, show_default=True, help='Число потоков-обработчиков')
+def worker_command(threads):
+    """Запустить обработчик фоновых задач."""
+    init_storage()
+    job_runner.ensure_started(threads)
+    click.echo(f'Обработчик задач запущен: {threads} потоков')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        job_runner.stop(timeout=30)
+
+# Команды обслуживания хранилища блобов
+def hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+@app.cli.command('migrate-blobs')
+@click.option('--batch-size', default=500, show_default=True)
+def migrate_blobs_command(batch_size):
+    """Перенести файлы из папок проектов в хранилище блобов."""
+    init_storage()
+    upload_folder = app.config['UPLOAD_FOLDER']
+    moved = missing = last_id = 0
+    while True:
+        records = (ProjectFile.query
+                   .filter(ProjectFile.blob_sha256.is_(None), ProjectFile.id > last_id)
+                   .order_by(ProjectFile.id).limit(batch_size).all())
+        if not records:
+            break
+        last_id = records[-1].id
+        blobs = {}
+        originals = []
+        for record in records:
+            path = os.path.join(upload_folder, record.filepath)
+            if not os.path.exists(path):
+                # Файл мог уже попасть в хранилище при прерванном запуске - ищем блоб по хешу
+                known = record.sha256 and os.path.join(upload_folder, blob_relpath(record.sha256))
+                if not known or not os.path.exists(known):
+                    missing += 1
+                    continue
+                sha256, size = record.sha256, os.path.getsize(known)
+                record.filepath = blob_relpath(sha256)
+            else:
+                sha256, size = hash_file(path)
+                record.filepath = link_blob(path, sha256)
+                originals.append(path)
+            record.blob_sha256 = record.sha256 = sha256
+            record.size = size
+            blobs[sha256] = (size, blobs.get(sha256, (0, 0))[1] + 1)
+            moved += 1
+        add_blob_refs(blobs)
+        db.session.commit()
+        # Старые пути удаляем только после коммита: до него строки указывают на них
+        for path in originals:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        click.echo(f'Перенесено файлов: {moved}')
+    # Удаляем опустевшие папки проектов
+    for (files_folder,) in db.session.execute(db.select(Project.files_folder).where(Project.files_folder.isnot(None))):
+        try:
+            os.rmdir(os.path.join(upload_folder, files_folder))
+        except OSError:
+            pass
+    click.echo(f'Готово: перенесено {moved}, не найдено на диске {missing}')
+
+@app.cli.command('backfill-languages')
+@click.option('--batch-size', default=500, show_default=True)
+def backfill_languages_command(batch_size):
+    """Заполнить таблицу языков из текстового поля Project.languages."""
+    init_storage()
+    filled = last_id = 0
+    while True:
+        batch = backfill_languages_batch(db.session, last_id, batch_size)
+        if batch is None:
+            break
+        last_id, count = batch
+        filled += count
+        db.session.commit()
+    click.echo(f'Заполнено проектов: {filled}')
+
+@app.cli.command('recount-user-stats')
+def recount_user_stats_command():
+    """Пересчитать счётчики проектов, звёзд и файлов всех пользователей."""
+    init_storage()
+    recount_user_stats(db.session)
+    db.session.commit()
+    click.echo(f'Пересчитано пользователей: {db.session.query(UserStats).count()}')
+
+@app.cli.command('rebuild-trending')
+def rebuild_trending_command():
+    """Пересчитать оценки трендов по журналу звёзд."""
+    init_storage()
+    with db.engine.begin() as conn:
+        count = rebuild_trending(conn)
+    page_cache.invalidate('trending')
+    click.echo(f'Проектов в трендах: {count}')
+
+# Статика
+def build_compressed_assets():
+    built = 0
+    for name, (digest, path) in static_manifest().items():
+        if not is_compressible(mimetypes.guess_type(name)[0]):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        for encoding in available_encodings():
+            with open(path + ('.br' if encoding == 'br' else '.gz'), 'wb') as f:
+                f.write(compress(data, encoding, best=True))
+            built += 1
+    return built
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Подготовить сжатые варианты (.gz, .br) файлов из static/."""
+    click.echo(f'Сжатых файлов: {build_compressed_assets()}')
+
+def remove_blob_file(path, sha256, has_row, cutoff):
+    # Между проверкой и удалением загрузка того же содержимого могла снова сослаться на блоб.
+    # Строка удаляется условием refcount <= 0, файл сначала переименовывается (после этого
+    # store_blob положит новую копию), и если store_blob успел обновить mtime - всё возвращается
+    if has_row:
+        result = db.session.execute(db.delete(Blob).where(Blob.sha256 == sha256, Blob.refcount <= 0))
+        if result.rowcount != 1:
+            db.session.rollback()
+            return False
+    trash = path + '.gc'
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        db.session.rollback()
+        return False
+    if os.path.getmtime(trash) > cutoff:
+        os.rename(trash, path)
+        db.session.rollback()
+        return False
+    db.session.commit()
+    os.unlink(trash)
+    return True
+
+@app.cli.command('gc-blobs')
+@click.option('--grace', default=3600, show_default=True,
+              help='Не трогать файлы моложе указанного числа секунд')
+@click.option('--dry-run', is_flag=True)
+def gc_blobs_command(grace, dry_run):
+    """Удалить блобы, на которые не ссылается ни один файл проекта."""
+    init_storage()
+    upload_folder = app.config['UPLOAD_FOLDER']
+    cutoff = time.time() - grace
+    # Пересчитываем счётчики ссылок, чтобы исправить расхождения после сбоев
+    db.session.execute(db.text(
+        'UPDATE blob SET refcount = '
+        '(SELECT COUNT(*) FROM project_file WHERE project_file.blob_sha256 = blob.sha256)'
+    ))
+    db.session.commit()
+    removed = freed = 0
+    # Блобы без ссылок и файлы, для которых нет строки в таблице blob (например, после неудачного коммита)
+    for dirpath, _, filenames in os.walk(os.path.join(upload_folder, 'blobs')):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name.endswith('.gc'):
+                # Остаток прерванного удаления: возвращаем на место, решение примет следующий проход
+                if not dry_run:
+                    if os.path.exists(path[:-3]):
+                        os.unlink(path)
+                    else:
+                        os.rename(path, path[:-3])
+                continue
+            if os.path.getmtime(path) > cutoff:
+                continue
+            row = db.session.execute(db.select(Blob.refcount).where(Blob.sha256 == name)).first()
+            if row is not None and row.refcount > 0:
+                continue
+            size = os.path.getsize(path)
+            if not dry_run and not remove_blob_file(path, name, has_row=row is not None, cutoff=cutoff):
+                continue
+            freed += size
+            removed += 1
+    # Забытые временные файлы загрузок
+    for dirpath, _, filenames in os.walk(os.path.join(upload_folder, '.tmp')):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.getmtime(path) <= cutoff:
+                freed += os.path.getsize(path)
+                if not dry_run:
+                    os.unlink(path)
+    # Брошенные возобновляемые загрузки и их файлы. Сборка, которая давно не двигается и
+    # для которой нет живой задачи, тоже брошена. Файл части неудавшейся загрузки больше
+    # не нужен, сама строка живёт до истечения TTL, чтобы клиент увидел ошибку
+    expired = datetime.utcfromtimestamp(time.time() - app.config['RESUMABLE_UPLOAD_TTL'])
+    finalize_pending = db.select(Job.id).where(
+        Job.kind == 'finalize_upload', Job.status.in_(['queued', 'running']),
+        Job.payload.contains(UploadSession.id),
+    ).exists()
+    stale = db.session.execute(db.select(UploadSession.id).where(
+        UploadSession.updated_at < expired,
+        or_(UploadSession.status.in_(['open', 'failed']),
+            and_(UploadSession.status == 'finalizing', ~finalize_pending)),
+    )).scalars().all()
+    known = set(db.session.execute(db.select(UploadSession.id).where(
+        UploadSession.status.in_(['open', 'finalizing']))).scalars()) - set(stale)
+    for dirpath, _, filenames in os.walk(os.path.join(upload_folder, '.resumable')):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if name not in known and os.path.getmtime(path) <= cutoff:
+                freed += os.path.getsize(path)
+                if not dry_run:
+                    os.unlink(path)
+    if stale and not dry_run:
+        db.session.execute(db.delete(UploadChunk).where(UploadChunk.upload_id.in_(stale)))
+        db.session.execute(db.delete(UploadSession).where(UploadSession.id.in_(stale)))
+        db.session.commit()
+    # Строки блобов, файлы которых уже пропали с диска
+    if not dry_run:
+        db.session.execute(db.delete(Blob).where(
+            Blob.refcount <= 0, Blob.created_at < datetime.utcfromtimestamp(cutoff)))
+        db.session.commit()
+    click.echo(f'Удалено блобов: {removed}, освобождено байт: {freed}')
+
+# Перенос данных: flask data export / import. Формат - DIR/data.jsonl, по записи на строку:
+#   {"type": "user", "username": ..., "email": ..., "password_hash": ... (или "password"), "created_at": ...}
+#   {"type": "project", "author": "<username>", "title": ..., "description": ..., "repository_url": ...,
+#    "languages": "Python:60, Go:40", "stars": 0, "created_at": ...,
+#    "files": [{"filename": ..., "path": "<путь относительно DIR>", "size": ..., "sha256": ...}]}
+# Пользователи должны идти раньше своих проектов. Импорт читает файл пачками: пачка - одна
+# транзакция с вставками executemany и номером последней строки в import_checkpoint, поэтому
+# прерванный импорт продолжается с первой незакоммиченной строки. Файлы хешируются и
+# копируются в хранилище блобов пулом потоков; блобы прерванной пачки без ссылок убирает gc-blobs.
+data_cli = AppGroup('data', help='Импорт и экспорт пользователей, проектов и файлов.')
+
+def import_records(path, start_line):
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if number <= start_line or not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise click.ClickException(f'Строка {number}: {e}')
+            yield number, record
+
+def parse_import_datetime(value, number):
+    if value is None:
+        return datetime.utcnow()
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise click.ClickException(f'Строка {number}: неверная дата {value!r}')
+
+def import_file(base_dir, entry):
+    # Копирует файл в хранилище, считая SHA-256 по пути; уже известный блоб не копируется
+    src = os.path.join(base_dir, entry['path'])
+    sha256, size = entry.get('sha256'), entry.get('size')
+    if sha256 and SHA256_RE.match(sha256) and size is not None:
+        dest = os.path.join(app.config['UPLOAD_FOLDER'], blob_relpath(sha256))
+        if os.path.exists(dest) and os.path.getsize(dest) == size:
+            os.utime(dest)
+            return sha256, size, blob_relpath(sha256), detect_file_language(entry['filename'], dest)
+    stream = HashingTempFile(upload_tmp_dir())
+    try:
+        with open(src, 'rb') as f:
+            shutil.copyfileobj(f, stream, app.config['UPLOAD_CHUNK_SIZE'])
+        stream.close()
+    except BaseException:
+        stream.close()
+        os.unlink(stream.name)
+        raise
+    if sha256 and stream.sha256 != sha256:
+        os.unlink(stream.name)
+        raise click.ClickException(f'{entry["path"]}: SHA-256 не совпадает с указанным')
+    language = detect_file_language(entry['filename'], stream.name)
+    return stream.sha256, stream.size, store_blob(stream.name, stream.sha256), language
+
+def import_users(records, pool):
+    rows, plain = [], []
+    for number, record in records:
+        if not record.get('username') or not record.get('email'):
+            raise click.ClickException(f'Строка {number}: у пользователя нет username или email')
+        row = {
+            'username': record['username'],
+            'email': record['email'],
+            'password_hash': record.get('password_hash'),
+            'created_at': parse_import_datetime(record.get('created_at'), number),
+        }
+        if not row['password_hash']:
+            if not record.get('password'):
+                raise click.ClickException(f'Строка {number}: нет password_hash или password')
+            plain.append((row, record['password']))
+        rows.append(row)
+    # Пароли открытым текстом хешируются в пуле параллельно
+    method = app.config['PASSWORD_HASH_METHOD']
+    hashes = pool.map(lambda item: generate_password_hash(item[1], method), plain)
+    for (row, _), password_hash in zip(plain, hashes):
+        row['password_hash'] = password_hash
+    # Уже существующие имена и адреса пропускаются: их проекты достаются существующим пользователям
+    if rows:
+        db.session.execute(insert_ignore(User.__table__), rows)
+    return len(rows)
+
+def import_projects(records, base_dir, pool, authors):
+    entries = []
+    for number, record in records:
+        for entry in record.get('files') or []:
+            if not entry.get('path') or not secure_filename(entry.get('filename') or ''):
+                raise click.ClickException(f'Строка {number}: у файла нет path или filename')
+            entries.append(entry)
+    stored = iter(pool.map(lambda entry: import_file(base_dir, entry), entries))
+    projects, project_files, auto = [], [], []
+    for number, record in records:
+        user_id = authors.get(record.get('author'))
+        if user_id is None:
+            raise click.ClickException(f'Строка {number}: автор {record.get("author")!r} не найден')
+        if not record.get('title'):
+            raise click.ClickException(f'Строка {number}: у проекта нет title')
+        files = []
+        for entry in record.get('files') or []:
+            sha256, size, relpath, language = next(stored)
+            files.append({
+                'filename': secure_filename(entry['filename']),
+                'filepath': relpath,
+                'upload_date': parse_import_datetime(entry.get('upload_date'), number),
+                'size': size,
+                'sha256': sha256,
+                'blob_sha256': sha256,
+                'language': language,
+            })
+        pairs = parse_languages(record.get('languages') or '', strict=False)
+        languages_auto = record.get('languages_auto', not pairs)
+        if languages_auto:
+            # Языки по файлам, как в detect_languages_job: из файлов с одинаковым именем - последний
+            latest = {file['filename']: file for file in files}
+            totals = {}
+            for file in latest.values():
+                if file['language']:
+                    totals[file['language']] = totals.get(file['language'], 0) + (file['size'] or 0)
+            pairs = language_breakdown(totals)
+        projects.append({
+            'title': record['title'],
+            'description': record.get('description') or '',
+            'repository_url': record.get('repository_url'),
+            'languages': format_languages(pairs) or None,
+            'languages_auto': bool(languages_auto),
+            'stars': record.get('stars') or 0,
+            'created_at': parse_import_datetime(record.get('created_at'), number),
+            'user_id': user_id,
+            'files_folder': uuid.uuid4().hex[:8],
+        })
+        project_files.append(files)
+        auto.append(pairs)
+    if not projects:
+        return 0, 0, 0
+    project_ids = db.session.execute(
+        db.insert(Project).returning(Project.id, sort_by_parameter_order=True), projects
+    ).scalars().all()
+    languages, files, blobs = [], [], {}
+    for project_id, pairs, rows in zip(project_ids, auto, project_files):
+        languages.extend({'project_id': project_id, 'name': name, 'percent': percent, 'position': position}
+                         for position, (name, percent) in enumerate(pairs))
+        for row in rows:
+            row['project_id'] = project_id
+            files.append(row)
+            blobs[row['sha256']] = (row['size'], blobs.get(row['sha256'], (0, 0))[1] + 1)
+    if languages:
+        db.session.execute(db.insert(ProjectLanguage), languages)
+    if files:
+        add_blob_refs(blobs)
+        db.session.execute(db.insert(ProjectFile), files)
+    return len(projects), len(files), sum(row['size'] for row in files)
+
+def save_import_checkpoint(source, line):
+    table = ImportCheckpoint.__table__
+    values = {'line': line, 'updated_at': datetime.utcnow()}
+    if not db.session.execute(table.update().where(table.c.source == source).values(**values)).rowcount:
+        db.session.execute(table.insert().values(source=source, **values))
+
+@data_cli.command('import')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--batch-size', default=500, show_default=True, help='Записей в одной транзакции')
+@click.option('--workers', default=8, show_default=True, help='Потоков хеширования и копирования файлов')
+@click.option('--restart', is_flag=True, help='Начать заново, забыв сохранённую позицию')
+def data_import_command(directory, batch_size, workers, restart):
+    """Импортировать пользователей, проекты и файлы из DIRECTORY/data.jsonl."""
+    init_storage()
+    path = os.path.realpath(os.path.join(directory, 'data.jsonl'))
+    if not os.path.exists(path):
+        raise click.ClickException(f'Не найден {path}')
+    if restart:
+        db.session.execute(db.delete(ImportCheckpoint).where(ImportCheckpoint.source == path))
+        db.session.commit()
+    start_line = db.session.execute(
+        db.select(ImportCheckpoint.line).where(ImportCheckpoint.source == path)).scalar() or 0
+    if start_line:
+        click.echo(f'Продолжение со строки {start_line + 1}')
+    started = time.monotonic()
+    totals = collections.Counter()
+    records = import_records(path, start_line)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            users = [(n, r) for n, r in batch if r.get('type') == 'user']
+            projects = [(n, r) for n, r in batch if r.get('type') == 'project']
+            unknown = [n for n, r in batch if r.get('type') not in ('user', 'project')]
+            if unknown:
+                raise click.ClickException(f'Строка {unknown[0]}: неизвестный type')
+            totals['users'] += import_users(users, pool)
+            names = {r.get('author') for _, r in projects}
+            authors = dict(db.session.execute(
+                db.select(User.username, User.id).where(User.username.in_(names))).all()) if names else {}
+            count, file_count, size = import_projects(projects, os.path.dirname(path), pool, authors)
+            totals['projects'] += count
+            totals['files'] += file_count
+            totals['bytes'] += size
+            touched = set(authors.values()) | set(db.session.execute(
+                db.select(User.id).where(User.username.in_([r['username'] for _, r in users]))).scalars())
+            if touched:
+                recount_user_stats(db.session, touched)
+            save_import_checkpoint(path, batch[-1][0])
+            db.session.commit()
+            page_cache.invalidate('feed', 'trending', *(f'user:{user_id}' for user_id in touched))
+            elapsed = max(time.monotonic() - started, 1e-6)
+            click.echo(f"строка {batch[-1][0]}: пользователей {totals['users']}, проектов {totals['projects']}, "
+                       f"файлов {totals['files']} ({totals['bytes'] / 2**20:.1f} МБ); "
+                       f"{(totals['users'] + totals['projects']) / elapsed:.0f} записей/с, "
+                       f"{totals['bytes'] / 2**20 / elapsed:.1f} МБ/с")
+    click.echo(f'Импорт завершён за {time.monotonic() - started:.1f} с')
+
+def export_blob(directory, sha256):
+    # Блобы копируются в DIR/files/ab/<sha256>; уже скопированные при прошлом запуске пропускаются
+    relpath = os.path.join('files', sha256[:2], sha256)
+    dest = os.path.join(directory, relpath)
+    src = os.path.join(app.config['UPLOAD_FOLDER'], blob_relpath(sha256))
+    if not os.path.exists(dest) or os.path.getsize(dest) != os.path.getsize(src):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(src, dest + '.part')
+        os.replace(dest + '.part', dest)
+    return relpath
+
+@data_cli.command('export')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--batch-size', default=1000, show_default=True)
+@click.option('--workers', default=8, show_default=True, help='Потоков копирования файлов')
+def data_export_command(directory, batch_size, workers):
+    """Выгрузить пользователей, проекты и файлы в DIRECTORY (data.jsonl и files/)."""
+    init_storage()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'data.jsonl')
+    started = time.monotonic()
+    totals = collections.Counter()
+
+    def report():
+        elapsed = max(time.monotonic() - started, 1e-6)
+        click.echo(f"пользователей {totals['users']}, проектов {totals['projects']}, файлов {totals['files']} "
+                   f"({totals['bytes'] / 2**20:.1f} МБ); {(totals['users'] + totals['projects']) / elapsed:.0f} "
+                   f"записей/с, {totals['bytes'] / 2**20 / elapsed:.1f} МБ/с")
+
+    with open(path + '.part', 'w', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        last_id = 0
+        while True:
+            users = db.session.execute(
+                db.select(User.id, User.username, User.email, User.password_hash, User.created_at)
+                .where(User.id > last_id).order_by(User.id).limit(batch_size)
+            ).all()
+            if not users:
+                break
+            last_id = users[-1].id
+            for user in users:
+                out.write(json.dumps({
+                    'type': 'user', 'id': user.id, 'username': user.username, 'email': user.email,
+                    'password_hash': user.password_hash, 'created_at': isoformat(user.created_at),
+                }, ensure_ascii=False) + '\n')
+            totals['users'] += len(users)
+            report()
+        last_id = 0
+        while True:
+            projects = db.session.execute(
+                db.select(Project.id, Project.title, Project.description, Project.repository_url,
+                          Project.languages, Project.languages_auto, Project.stars, Project.created_at,
+                          User.username)
+                .join(User, User.id == Project.user_id)
+                .where(Project.id > last_id).order_by(Project.id).limit(batch_size)
+            ).all()
+            if not projects:
+                break
+            last_id = projects[-1].id
+            files = collections.defaultdict(list)
+            for file in db.session.execute(
+                db.select(ProjectFile.project_id, ProjectFile.filename, ProjectFile.size,
+                          ProjectFile.sha256, ProjectFile.blob_sha256, ProjectFile.upload_date)
+                .where(ProjectFile.project_id.in_([p.id for p in projects]))
+                .order_by(ProjectFile.project_id, ProjectFile.id)
+            ):
+                files[file.project_id].append(file)
+            # Файлы вне хранилища блобов (до migrate-blobs) не выгружаются
+            shas = {file.blob_sha256 for rows in files.values() for file in rows if file.blob_sha256}
+            paths = dict(zip(shas, pool.map(lambda sha256: export_blob(directory, sha256), shas)))
+            for project in projects:
+                entries = [{
+                    'filename': file.filename, 'path': paths[file.blob_sha256], 'size': file.size,
+                    'sha256': file.blob_sha256, 'upload_date': isoformat(file.upload_date),
+                } for file in files[project.id] if file.blob_sha256]
+                out.write(json.dumps({
+                    'type': 'project', 'id': project.id, 'author': project.username, 'title': project.title,
+                    'description': project.description, 'repository_url': project.repository_url,
+                    'languages': project.languages, 'languages_auto': project.languages_auto,
+                    'stars': project.stars, 'created_at': isoformat(project.created_at), 'files': entries,
+                }, ensure_ascii=False) + '\n')
+                totals['files'] += len(entries)
+                totals['bytes'] += sum(entry['size'] or 0 for entry in entries)
+            totals['projects'] += len(projects)
+            report()
+    os.replace(path + '.part', path)
+    click.echo(f'Экспорт завершён за {time.monotonic() - started:.1f} с: {path}')
+
+app.cli.add_command(data_cli)
+
+# Запуск в production: несколько процессов с пулом потоков в каждом. Главный процесс один раз
+# готовит хранилище, открывает сокет и форкает воркеры, упавший воркер перезапускается.
+# SIGTERM/SIGINT - плавная остановка: воркеры перестают принимать соединения, дорабатывают
+# текущие запросы, сбрасывают накопленные звёзды и останавливают фоновые задачи.
+def dispose_engines(close=True):
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+
+def start_worker_process():
+    # Соединения из пула родителя нельзя использовать после fork: забываем их, не закрывая
+    dispose_engines(close=False)
+    job_runner.ensure_started()
+
+def stop_worker_process(timeout=None):
+    job_runner.stop(timeout)
+    try:
+        star_buffer.flush()
+    except Exception:
+        app.logger.exception('Не удалось записать звёзды')
+    dispose_engines()
+
+def default_worker_count():
+    # Учитываем ограничение по ядрам в контейнере
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+class ServeRequestHandler(WSGIRequestHandler):
+    # Соединение закрывается после ответа: keep-alive занимал бы поток пула и мешал остановке
+    protocol_version = 'HTTP/1.0'
+
+# WSGI-сервер werkzeug с ограниченным пулом потоков вместо потока на каждое соединение
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, threads, fd=None):
+        # С fd werkzeug вызывает server_close() ещё внутри __init__, пул к этому моменту не нужен
+        self.pool = None
+        self.request_queue_size = app.config['SERVE_BACKLOG']
+        super().__init__(host, port, app, handler=ServeRequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='http')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+def serve_in_process(host, port, threads, fd=None):
+    server = PooledWSGIServer(host, port, threads, fd=fd)
+
+    def stop(signum, frame):
+        # shutdown() ждёт выхода из serve_forever, поэтому вызываем его из другого потока
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    start_worker_process()
+    server.serve_forever()
+    stop_worker_process(app.config['SERVE_GRACEFUL_TIMEOUT'])
+
+class PreforkServer:
+    def __init__(self, host, port, workers, threads):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.children = {}  # pid -> время запуска
+        self.stopping = False
+        self.listener = None
+
+    def run(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        self.listener = socket.create_server(
+            (self.host, self.port), family=family, backlog=app.config['SERVE_BACKLOG'])
+        # Воркеры получат копии соединений с базой, поэтому закрываем их до fork
+        dispose_engines()
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        try:
+            while not self.stopping:
+                while len(self.children) < self.workers and not self.stopping:
+                    self.spawn()
+                self.reap()
+                time.sleep(0.5)
+        finally:
+            self.terminate()
+            self.listener.close()
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+        code = 0
+        try:
+            serve_in_process(self.host, self.port, self.threads, fd=self.listener.fileno())
+        except BaseException:
+            app.logger.exception('Воркер %s завершился с ошибкой', os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            started = self.children.pop(pid, None)
+            if started is not None and not self.stopping:
+                app.logger.warning('Воркер %s завершился (статус %s), запускаем новый', pid, status)
+                # Не перезапускаем в цикле воркер, который падает сразу после старта
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+
+    def terminate(self):
+        self.stopping = True
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + app.config['SERVE_GRACEFUL_TIMEOUT']
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.children.pop(pid)
+
+def run_gunicorn(host, port, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class EntardApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f'[{host}]:{port}' if ':' in host else f'{host}:{port}',
+                'workers': workers,
+                'threads': threads,
+                'worker_class': 'gthread',
+                'backlog': app.config['SERVE_BACKLOG'],
+                'graceful_timeout': app.config['SERVE_GRACEFUL_TIMEOUT'],
+                # Приложение загружается в главном процессе один раз, до fork
+                'preload_app': True,
+                'post_fork': lambda server, worker: start_worker_process(),
+                'worker_exit': lambda server, worker: stop_worker_process(app.config['SERVE_GRACEFUL_TIMEOUT']),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            create_app()
+            dispose_engines()
+            return app
+
+    EntardApplication().run()
+
+def run_server(host=None, port=None, workers=None, threads=None, runner=None):
+    host = host or app.config['SERVE_HOST']
+    port = port or app.config['SERVE_PORT']
+    workers = workers or app.config['SERVE_WORKERS'] or default_worker_count()
+    threads = threads or app.config['SERVE_THREADS']
+    runner = runner or app.config['SERVE_RUNNER']
+    if workers > 1 and not page_cache_shared_path() and app.config['PAGE_CACHE_ENABLED']:
+        # Инвалидации из памяти одного процесса не дойдут до остальных
+        app.logger.warning('Кэш страниц отключён: при нескольких воркерах нужен PAGE_CACHE_SHARED_PATH')
+        app.config['PAGE_CACHE_ENABLED'] = False
+    if runner == 'gunicorn':
+        run_gunicorn(host, port, workers, threads)
+        return
+    create_app()
+    if workers == 1 or not hasattr(os, 'fork'):
+        serve_in_process(host, port, threads)
+    else:
+        PreforkServer(host, port, workers, threads).run()
+
+@app.cli.command('serve', with_appcontext=False)
+@click.option('--host', help='Адрес (по умолчанию SERVE_HOST)')
+@click.option('--port', type=int, help='Порт (по умолчанию PORT)')
+@click.option('--workers', '-w', type=int, help='Число процессов (по умолчанию по числу ядер)')
+@click.option('--threads', '-t', type=int, help='Потоков в каждом процессе')
+@click.option('--runner', type=click.Choice(['builtin', 'gunicorn']), help='Сервер (по умолчанию SERVE_RUNNER)')
+def serve_command(host, port, workers, threads, runner):
+    """Запустить production-сервер с несколькими процессами."""
+    if (runner or app.config['SERVE_RUNNER']) == 'gunicorn':
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            raise click.ClickException('gunicorn не установлен: pip install gunicorn')
+    run_server(host, port, workers, threads, runner)
+
+# python entard.py - один процесс, как и раньше; несколько воркеров - через `flask serve`
+# или явный SERVE_WORKERS
 if __name__ == '__main__':
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port)
+    run_server(workers=app.config['SERVE_WORKERS'] or 1)